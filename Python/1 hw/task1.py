@@ -1,25 +1,150 @@
 __author__ = 'Evgeny Eltyshev'
-from string import punctuation
+import io
+import os
 import re
 import sys
+import mmap
 import random
+import multiprocessing
+from optparse import OptionParser
+
+WORD_PATTERN = r"[\w']+|[.,!?;]"
+WORD_REGEX = re.compile(WORD_PATTERN)
+
+CHUNK_SIZE = 1024 * 1024
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 
 def words(fileobj):
-    r = re.compile(r'[\s{}]+'.format(re.escape(punctuation)))
     for line in fileobj:
-        for word in re.findall(r"[\w']+|[.,!?;]", line):
+        for word in WORD_REGEX.findall(line):
             yield word
 
-if __name__ == "__main__":
-    fileobj = open(sys.argv[1])
-    for word in words(fileobj):
-        if len(word) < 3:
-            print word,
+_mappings = dict()
+
+def mapping(file_path):
+    """Read-only mapping of a file, made once per process."""
+    buffer = _mappings.get(file_path)
+    if buffer is None:
+        with open(file_path, 'rb') as fileobj:
+            buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        _mappings[file_path] = buffer
+    return buffer
+
+def chunks(fileobj, chunk_size=CHUNK_SIZE):
+    """Yield blocks of whole lines, about chunk_size bytes each."""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            return
+        if not chunk.endswith('\n'):
+            chunk += fileobj.readline()
+        yield chunk
+
+def mapped_ranges(file_path, chunk_size=CHUNK_SIZE):
+    """Like chunks(), but yields (file_path, start, end) ranges of the mapping.
+
+    The words of a range are matched in place: no block is copied out of
+    the file, only the matched words are materialized.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
+    buffer = mapping(file_path)
+    position = 0
+    while position < len(buffer):
+        line_end = buffer.find('\n', min(position + chunk_size, len(buffer)))
+        cut = len(buffer) if line_end < 0 else line_end + 1
+        yield file_path, position, cut
+        position = cut
+
+def chunk_words(chunk):
+    """Words of a block of text or of a mapped_ranges() range."""
+    if isinstance(chunk, tuple):
+        file_path, start, end = chunk
+        return WORD_REGEX.findall(mapping(file_path), start, end)
+    return WORD_REGEX.findall(chunk)
+
+def scramble(words, rng):
+    """Shuffle the inner letters of every word longer than two letters."""
+    random_ = rng.random
+    scrambled = []
+    append = scrambled.append
+    for word in words:
+        last = len(word) - 1
+        if last < 2:
+            append(word)
             continue
-        middle_indexes = range(len(word)-2)
-        random.shuffle(middle_indexes)
-        letters = [word[0]]
-        for index in middle_indexes:
-            letters.append(word[index + 1])
-        letters.append(word[-1])
-        print ''.join(letters),
\ No newline at end of file
+        # Fisher-Yates over positions 1..last-1, inlined: random.shuffle
+        # costs a call and a list copy per word
+        letters = list(word)
+        for index in xrange(last - 1, 1, -1):
+            other = int(random_() * index) + 1
+            letters[index], letters[other] = letters[other], letters[index]
+        append(''.join(letters))
+    return scrambled
+
+def scramble_chunk(task):
+    """Scramble the words of one chunk, return them joined by spaces.
+
+    Every chunk gets its own generator seeded from the run seed and the
+    chunk number, so the output does not depend on the number of jobs.
+    """
+    seed, index, chunk = task
+    rng = random.Random((seed << 32) + index)
+    return ' '.join(scramble(chunk_words(chunk), rng))
+
+def scramble_chunks(chunk_source, output, seed, jobs=1):
+    tasks = ((seed, index, chunk) for index, chunk in enumerate(chunk_source))
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(scramble_chunk, tasks)
+    else:
+        results = (scramble_chunk(task) for task in tasks)
+
+    separator = ''
+    try:
+        for text in results:
+            if not text:
+                continue
+            output.write(separator)
+            output.write(text)
+            separator = ' '
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    # the same trailing newline print leaves after 'print word,'
+    if separator:
+        output.write('\n')
+
+if __name__ == "__main__":
+    parser = OptionParser(usage='%prog [options] <file>')
+    parser.add_option('--mmap', action='store_true', dest='use_mmap',
+                      default=False,
+                      help='memory-map the input and match words in place')
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      dest='jobs', default=1,
+                      help='number of worker processes')
+    parser.add_option('-s', '--seed', type='int', metavar='N',
+                      dest='seed', default=None,
+                      help='seed of the shuffles, for reproducible output')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.print_help()
+        exit(-1)
+
+    seed = options.seed
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    if options.use_mmap:
+        chunk_source = mapped_ranges(args[0])
+    else:
+        chunk_source = chunks(open(args[0]))
+
+    output = io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'w', closefd=False),
+                               OUTPUT_BUFFER_SIZE)
+    scramble_chunks(chunk_source, output, seed, options.jobs)
+    output.flush()
@@ -1,7 +1,62 @@
 __author__ = 'Evgeny Eltyshev'
 
 import os
-import sys
+import mmap
+import math
+import array
+import heapq
+import random
+import struct
+import operator
+import hashlib
+import pickle
+import multiprocessing
+from optparse import OptionParser
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+UNDEFINED_VALUE = "None"
+NUMERIC_TYPES = {
+    'int': int,
+    'float': float,
+}
+
+def infer_column_type(values):
+    """'int', 'float' or 'categorical': the narrowest type of the known values."""
+    known = [value for value in values if value != UNDEFINED_VALUE]
+    for type_name in ('int', 'float'):
+        try:
+            map(NUMERIC_TYPES[type_name], known)
+        except ValueError:
+            continue
+        return type_name
+
+    return 'categorical'
+
+def number_category(value):
+    """The category a number counts under once its column turns categorical.
+
+    Equal numbers share one category however they were spelled: 7, 7.0
+    and '007' all count as '7'.
+    """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+def cell_category(cell):
+    """The category of a raw cell of a column that turned categorical."""
+    for number_type in (int, float):
+        try:
+            return number_category(number_type(cell))
+        except ValueError:
+            pass
+    return cell
+
+class ColumnTypeError(ValueError):
+    """A value that does not fit a numeric column."""
 
 class ColumnProcessor:
     KNOWN_VALUES_CAPTION = "known_values"
@@ -12,31 +67,109 @@ class ColumnProcessor:
     MAX_CAPTION = "max"
     VARIANCE_CAPTION = "var"
 
-    def __init__(self, column_name):
+    APPROXIMATE_MARK = "(approx)"
+    APPROXIMATE_CAPTIONS = ()
+    ARRAY_TYPECODES = {
+        int: 'l',
+        float: 'd',
+    }
+    # state pickled before columns were typed is all int
+    value_type = int
+
+    def __init__(self, column_name, value_type=int):
         self.column_name = column_name
-        self.values = list()
+        self.value_type = value_type
+        self.values = array.array(self.ARRAY_TYPECODES[value_type])
         self.undefined_values_count = 0
 
     def add_value(self, value):
-        if (value == "None"):
-            self.undefined_values_count += 1
-            return
+        self.add_values((value,))
+
+    def add_values(self, values):
+        """Add a batch of raw cells, converted all at once.
+
+        Raises ColumnTypeError, leaving the state as it was, if a value
+        does not fit the column.
+        """
+        undefined_count = values.count(UNDEFINED_VALUE)
+        known = values
+        if undefined_count:
+            known = [value for value in values if value != UNDEFINED_VALUE]
+        if known:
+            self._add_known(self._convert(known))
+        self.undefined_values_count += undefined_count
+
+    def merge(self, other):
+        """Fold in the partial state of a later part of the same column."""
+        self.undefined_values_count += other.undefined_values_count
+        if other.value_type is float and self.value_type is int:
+            self._promote_to_float()
+        self._add_known(other.values)
 
-        self.values.append(int(value))
+    def _convert(self, values):
+        if self.value_type is int:
+            try:
+                return map(int, values)
+            except ValueError:
+                pass
+        try:
+            values = map(float, values)
+        except ValueError as error:
+            raise ColumnTypeError("column {0} was sampled as numeric: {1}".format(
+                self.column_name, error))
+        if self.value_type is int:
+            # a fractional value the type sample did not see
+            self._promote_to_float()
+        return values
+
+    def _add_known(self, values):
+        if isinstance(values, array.array) and (
+                not isinstance(self.values, array.array) or
+                values.typecode != self.values.typecode):
+            values = values.tolist()
+
+        size = len(self.values)
+        try:
+            self.values.extend(values)
+        except OverflowError:
+            # beyond a C long: keep arbitrary precision ints in a list
+            self.values = self.values[:size].tolist()
+            self.values.extend(values)
+
+    def _promote_to_float(self):
+        self.value_type = float
+        self.values = array.array(self.ARRAY_TYPECODES[float], self.values)
+
+    def _value_counts(self):
+        value_counts = dict()
+        for value in self.values:
+            value_counts[value] = value_counts.get(value, 0) + 1
+        return value_counts
 
     def print_stats(self):
-        self.__calculate_stats()
+        self._calculate_stats()
         print "{0}: ".format(self.column_name)
-        print "{0}: {1:.2f}".format(self.KNOWN_VALUES_CAPTION, self.known_values_share)
-        print "{0}: {1}".format(self.UNIQUE_CAPTION, self.unique_values_count)
-        print "{0}: {1:.2f}".format(self.MEAN_CAPTION, self.mean)
-        print "{0}: {1}".format(self.MEDIAN_CAPTION, self.median)
-        print "{0}: {1}".format(self.MIN_CAPTION, self.min)
-        print "{0}: {1}".format(self.MAX_CAPTION, self.max)
-        print "{0}: {1:.1f}".format(self.VARIANCE_CAPTION, self.variance)
+        self._print_stat(self.KNOWN_VALUES_CAPTION, "{0:.2f}", self.known_values_share)
+        self._print_stat(self.UNIQUE_CAPTION, "{0}", self.unique_values_count)
+        self._print_stat(self.MEAN_CAPTION, "{0:.2f}", self.mean)
+        self._print_stat(self.MEDIAN_CAPTION, "{0}", self.median)
+        self._print_stat(self.MIN_CAPTION, "{0}", self.min)
+        self._print_stat(self.MAX_CAPTION, "{0}", self.max)
+        self._print_stat(self.VARIANCE_CAPTION, "{0:.1f}", self.variance)
+        for caption, value_format, value in self._extra_stats():
+            self._print_stat(caption, value_format, value)
         print "\n"
 
-    def __calculate_stats(self):
+    def _print_stat(self, caption, value_format, value):
+        line = "{0}: ".format(caption) + value_format.format(value)
+        if caption in self.APPROXIMATE_CAPTIONS:
+            line += " " + self.APPROXIMATE_MARK
+        print line
+
+    def _extra_stats(self):
+        return []
+
+    def _calculate_stats(self):
         values_sum = sum(self.values)
         values_square_sum = sum((x ** 2 for x in self.values))
         values_count = len(self.values);
@@ -57,28 +190,710 @@ class ColumnProcessor:
         self.known_values_share = 1 - float(self.undefined_values_count) / values_count
 
 
+class StreamingColumnProcessor(ColumnProcessor):
+    """One-pass variant of ColumnProcessor.
+
+    Mean and variance are kept as Welford running accumulators, so no value
+    list is stored. Median and unique count stay exact: they are taken from
+    a value -> count histogram, which grows with every distinct value. On a
+    column of mostly unique values it needs about as much memory as
+    ColumnProcessor; ApproximateColumnProcessor is the fixed-size variant.
+    Every batch of values is folded in with its own sums, exact for ints.
+    """
+
+    def __init__(self, column_name, value_type=int):
+        ColumnProcessor.__init__(self, column_name, value_type)
+        self.values = None
+        self.value_counts = dict()
+        self.values_count = 0
+        self.running_mean = 0.0
+        self.running_m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def _add_known(self, values):
+        count = len(values)
+        if self.value_type is int:
+            values_sum = sum(values)
+            mean = float(values_sum) / count
+            m2 = float(count * sum(map(operator.mul, values, values)) -
+                       values_sum ** 2) / count
+        else:
+            mean = math.fsum(values) / count
+            m2 = math.fsum([(value - mean) ** 2 for value in values])
+
+        self._combine(count, mean, m2, min(values), max(values))
+        self._add_to_distribution(values)
+
+    def _add_to_distribution(self, values):
+        value_counts = self.value_counts
+        for value in values:
+            value_counts[value] = value_counts.get(value, 0) + 1
+
+    def merge(self, other):
+        self.undefined_values_count += other.undefined_values_count
+        if other.value_type is float:
+            self._promote_to_float()
+        if other.values_count == 0:
+            return
+
+        self._combine(other.values_count, other.running_mean, other.running_m2,
+                      other.min, other.max)
+        self._merge_distribution(other)
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        # Chan et al. pairwise update of the Welford accumulators
+        values_count = self.values_count + count
+        delta = mean - self.running_mean
+        self.running_mean += delta * count / values_count
+        self.running_m2 += m2 + delta ** 2 * self.values_count * count / values_count
+        self.values_count = values_count
+
+        if self.min is None or minimum < self.min:
+            self.min = minimum
+        if self.max is None or maximum > self.max:
+            self.max = maximum
+
+    def _promote_to_float(self):
+        # ints and the floats equal to them share histogram entries
+        self.value_type = float
+
+    def _value_counts(self):
+        return self.value_counts
+
+    def _merge_distribution(self, other):
+        for value, count in other.value_counts.iteritems():
+            self.value_counts[value] = self.value_counts.get(value, 0) + count
+
+    def _calculate_stats(self):
+        values_count = self.values_count
+
+        self.mean = self.running_mean
+        self.variance = self.running_m2 / (values_count - 1)    #unbiased sample variance
+        self._calculate_distribution_stats()
+        if self.value_type is float:
+            # the column may have held ints before it turned float
+            self.min, self.max = float(self.min), float(self.max)
+            self.median = float(self.median)
+        self.known_values_share = 1 - float(self.undefined_values_count) / values_count
+
+    def _calculate_distribution_stats(self):
+        values_count = self.values_count
+
+        # same order statistics as ColumnProcessor picks from sorted values
+        if (values_count % 2 == 0):
+            k = values_count / 2
+            self.median = (self.__nth_value(k) + self.__nth_value(k+1)) / 2
+        else:
+            self.median = self.__nth_value((values_count + 1) / 2)
+        self.unique_values_count = len(self.value_counts)
+
+    def __nth_value(self, index):
+        for value in sorted(self.value_counts):
+            index -= self.value_counts[value]
+            if index < 0:
+                # an int key may stand for a float column's value
+                return self.value_type(value)
+
+        raise IndexError("list index out of range")
+
+
+class KllSketch:
+    """KLL quantile sketch (Karnin, Lang, Liberty).
+
+    Items live in a stack of compactors; level h items weigh 2 ** h. A full
+    compactor is sorted and every other item is promoted to the next level,
+    so the sketch holds O(k) items and ranks are off by about eps * n with
+    eps ~ 1.7 / k.
+    """
+    RANK_ERROR_FACTOR = 1.7
+    CAPACITY_DECAY = 2.0 / 3
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.count = 0
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.random = random.Random(seed)
+        self.__grow()
+
+    @classmethod
+    def for_error(cls, rank_error, seed=0):
+        return cls(max(8, int(math.ceil(cls.RANK_ERROR_FACTOR / rank_error))), seed)
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.__compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.__grow()
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+        self.count += other.count
+        self.size = sum(len(compactor) for compactor in self.compactors)
+        while self.size >= self.max_size:
+            self.__compress()
+
+    def quantile(self, q):
+        weighted = sorted((value, 1 << level)
+                          for level, compactor in enumerate(self.compactors)
+                          for value in compactor)
+        total_weight = sum(weight for value, weight in weighted)
+        rank = q * total_weight
+        cumulative_weight = 0
+        for value, weight in weighted:
+            cumulative_weight += weight
+            if cumulative_weight >= rank:
+                return value
+
+        return weighted[-1][0]
+
+    def __capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * self.CAPACITY_DECAY ** depth)) + 1
+
+    def __grow(self):
+        self.compactors.append([])
+        self.max_size = sum(self.__capacity(level)
+                            for level in range(len(self.compactors)))
+
+    def __compress(self):
+        for level in range(len(self.compactors)):
+            compactor = self.compactors[level]
+            if len(compactor) >= self.__capacity(level):
+                if level + 1 >= len(self.compactors):
+                    self.__grow()
+                compactor.sort()
+                # an odd leftover item stays on this level
+                leftover = compactor[-1:] if len(compactor) % 2 else []
+                offset = self.random.randint(0, 1)
+                paired = len(compactor) - len(leftover)
+                self.compactors[level + 1].extend(compactor[offset:paired:2])
+                self.compactors[level] = leftover
+                break
+
+        self.size = sum(len(compactor) for compactor in self.compactors)
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2 ** precision one-byte registers.
+
+    The relative standard error is about 1.04 / sqrt(2 ** precision).
+    """
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+    HASH_MASK = (1 << 64) - 1
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.register_count = 1 << precision
+        self.registers = bytearray(self.register_count)
+
+    @classmethod
+    def for_error(cls, relative_error):
+        precision = int(math.ceil(math.log((1.04 / relative_error) ** 2, 2)))
+        return cls(min(max(precision, cls.MIN_PRECISION), cls.MAX_PRECISION))
+
+    def add(self, value):
+        hashed = self.__hash(value)
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        # position of the leftmost 1-bit among the remaining 64 - p bits
+        rank = 64 - self.precision - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLog sketches of different precision")
+        self.registers = bytearray(max(a, b) for a, b in
+                                   zip(self.registers, other.registers))
+
+    def cardinality(self):
+        m = self.register_count
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+
+        zero_registers = self.registers.count(b'\0')
+        if estimate <= 2.5 * m and zero_registers:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(float(m) / zero_registers)
+
+        return int(round(estimate))
+
+    def __hash(self, value):
+        if isinstance(value, float):
+            # integral floats count as the ints they equal, others by their bits
+            if value.is_integer():
+                value = int(value)
+            else:
+                value = struct.unpack('<q', struct.pack('<d', value))[0]
+        # splitmix64 finalizer: cheap and well mixed for integer keys
+        x = (value + 0x9E3779B97F4A7C15) & self.HASH_MASK
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & self.HASH_MASK
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & self.HASH_MASK
+        return x ^ (x >> 31)
+
+
+class ApproximateColumnProcessor(StreamingColumnProcessor):
+    """Streaming processor with fixed-size sketches instead of a histogram.
+
+    Median and percentiles come from a KLL sketch, the unique count from a
+    HyperLogLog; both are marked as approximate in the report.
+    """
+    APPROXIMATE_CAPTIONS = (StreamingColumnProcessor.UNIQUE_CAPTION,
+                            StreamingColumnProcessor.MEDIAN_CAPTION)
+    PERCENTILE_CAPTION = "p{0:g}"
+
+    def __init__(self, column_name, value_type=int, quantile_error=0.01,
+                 uniq_error=0.01, percentiles=()):
+        StreamingColumnProcessor.__init__(self, column_name, value_type)
+        self.value_counts = None
+        self.quantiles = KllSketch.for_error(quantile_error)
+        self.distinct = HyperLogLog.for_error(uniq_error)
+        self.percentiles = tuple(percentiles)
+        self.APPROXIMATE_CAPTIONS += tuple(self.PERCENTILE_CAPTION.format(percentile)
+                                           for percentile in self.percentiles)
+
+    def _add_to_distribution(self, values):
+        update = self.quantiles.update
+        add = self.distinct.add
+        for value in values:
+            update(value)
+            add(value)
+
+    def _merge_distribution(self, other):
+        self.quantiles.merge(other.quantiles)
+        self.distinct.merge(other.distinct)
+
+    def _value_counts(self):
+        # only the weighted items kept by the quantile sketch are known
+        value_counts = dict()
+        for level, compactor in enumerate(self.quantiles.compactors):
+            for value in compactor:
+                value_counts[value] = value_counts.get(value, 0) + (1 << level)
+        return value_counts
+
+    def _calculate_distribution_stats(self):
+        self.median = self.quantiles.quantile(0.5)
+        self.unique_values_count = self.distinct.cardinality()
+
+    def _extra_stats(self):
+        return [(self.PERCENTILE_CAPTION.format(percentile), "{0}",
+                 self.value_type(self.quantiles.quantile(percentile / 100.0)))
+                for percentile in self.percentiles]
+
+
+class NumpyColumnProcessor(ColumnProcessor):
+    """ColumnProcessor fed with whole chunks of parsed values.
+
+    Values are kept as int64 (or float64) arrays and every statistic is a
+    vectorized reduction; the formulas mirror ColumnProcessor so reports
+    are identical.
+    """
+    INT64_LIMIT = 2 ** 63
+
+    def __init__(self, column_name, value_type=int):
+        ColumnProcessor.__init__(self, column_name, value_type)
+        self.values = None
+        self.chunks = []
+
+    def add_chunk(self, values, undefined_count):
+        """Add float64 values, kept as int64 while they are all integral."""
+        self.undefined_values_count += undefined_count
+        if self.value_type is int and (values != np.floor(values)).any():
+            self._promote_to_float()
+        if self.value_type is int:
+            values = values.astype(np.int64)
+        self.chunks.append(values)
+
+    def merge(self, other):
+        self.undefined_values_count += other.undefined_values_count
+        if other.value_type is float:
+            self._promote_to_float()
+        self.chunks.extend(other.chunks)
+
+    def _promote_to_float(self):
+        # int64 chunks become float64 when they are concatenated
+        self.value_type = float
+
+    def _calculate_stats(self):
+        values = np.concatenate(self.chunks) if self.chunks else \
+            np.empty(0, dtype=np.int64)
+        values_count = values.size
+        scalar = self.value_type
+
+        if scalar is float:
+            values = values.astype(np.float64)
+            self.min = float(values.min())
+            self.max = float(values.max())
+            values_sum = float(values.sum())
+            values_square_sum = float((values * values).sum())
+        else:
+            self.min = int(values.min())
+            self.max = int(values.max())
+            bound = max(abs(self.min), abs(self.max))
+
+            values_sum = self.__exact_sum(values, bound)
+            values_square_sum = self.__exact_sum(values * values, bound ** 2) \
+                if bound ** 2 < self.INT64_LIMIT else \
+                sum(x ** 2 for x in values.tolist())
+
+        self.mean = float(values_sum) / values_count    #unbiased sample mean
+        sample_variance = float(values_square_sum) / values_count - self.mean ** 2
+        self.variance = float(values_count) / (values_count - 1) * sample_variance #unbiased sample variance
+
+        if (values_count % 2 == 0):
+            k = values_count / 2
+            sorted_part = np.partition(values, [k, k+1])
+            self.median = (scalar(sorted_part[k]) + scalar(sorted_part[k+1])) / 2
+        else:
+            k = (values_count + 1) / 2
+            self.median = scalar(np.partition(values, k)[k])
+        self.unique_values_count = np.unique(values).size
+        self.known_values_share = 1 - float(self.undefined_values_count) / values_count
+
+    def __exact_sum(self, values, bound):
+        if bound * values.size < self.INT64_LIMIT:
+            return int(values.sum(dtype=np.int64))
+
+        return sum(values.tolist())
+
+
+class CategoricalColumnProcessor(ColumnProcessor):
+    """Frequency counts of a string column, dictionary-encoded.
+
+    Every distinct value gets a code when first seen and the counts are an
+    array indexed by code, so a repeated value costs a dict lookup and no
+    new object. The same processor serves every mode: its size depends on
+    the number of distinct values only.
+
+    A numeric column that turned categorical counts numbers by value, both
+    those seen before the switch and the cells after it, so the categories
+    do not depend on where the switch happened.
+    """
+    TOP_CAPTION = "top"
+    TOP_VALUES = 5
+    # state pickled before numeric columns could turn categorical
+    counts_numbers = False
+
+    def __init__(self, column_name, value_type=str, **processor_options):
+        self.column_name = column_name
+        self.value_type = value_type
+        self.undefined_values_count = 0
+        self.codes = dict()
+        self.counts = array.array('l')
+
+    @classmethod
+    def from_numeric(cls, col_proc):
+        """Counts of what a numeric processor has seen, numbers as categories.
+
+        An approximate processor only knows the weighted items of its
+        quantile sketch, so the counts are marked approximate too.
+        """
+        categorical = cls(col_proc.column_name)
+        categorical.counts_numbers = True
+        categorical.undefined_values_count = col_proc.undefined_values_count
+        if col_proc.APPROXIMATE_CAPTIONS:
+            categorical.APPROXIMATE_CAPTIONS = (cls.UNIQUE_CAPTION, cls.TOP_CAPTION)
+        for value, count in col_proc._value_counts().iteritems():
+            categorical.__add(number_category(value), count)
+        return categorical
+
+    def merge(self, other):
+        self.undefined_values_count += other.undefined_values_count
+        if other.APPROXIMATE_CAPTIONS:
+            self.APPROXIMATE_CAPTIONS = other.APPROXIMATE_CAPTIONS
+        for value, code in other.codes.iteritems():
+            self.__add(value, other.counts[code])
+
+    def print_stats(self):
+        self._calculate_stats()
+        print "{0}: ".format(self.column_name)
+        self._print_stat(self.KNOWN_VALUES_CAPTION, "{0:.2f}", self.known_values_share)
+        self._print_stat(self.UNIQUE_CAPTION, "{0}", self.unique_values_count)
+        self._print_stat(self.TOP_CAPTION, "{0}", ', '.join(
+            "{0} ({1})".format(value, count) for value, count in self.top_values))
+        print "\n"
+
+    def _convert(self, values):
+        if self.counts_numbers:
+            return map(cell_category, values)
+        return values
+
+    def _add_known(self, values):
+        codes = self.codes
+        counts = self.counts
+        for value in values:
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(counts)
+                counts.append(0)
+            counts[code] += 1
+
+    def __add(self, value, count):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.counts)
+            self.counts.append(0)
+        self.counts[code] += count
+
+    def _calculate_stats(self):
+        counts = self.counts
+        values_count = sum(counts)
+
+        self.unique_values_count = len(self.codes)
+        # ties are broken by value, so the order does not depend on jobs
+        self.top_values = [(value, counts[code]) for value, code in heapq.nsmallest(
+            self.TOP_VALUES, self.codes.iteritems(),
+            key=lambda (value, code): (-counts[code], value))]
+        self.known_values_share = 1 - float(self.undefined_values_count) / values_count
+
+
+def column_type(col_proc):
+    """The type name a column processor currently holds."""
+    if isinstance(col_proc, CategoricalColumnProcessor):
+        # numbers of a column that turned categorical are still counted
+        # by value: a numeric part merges in the same way
+        return 'float' if col_proc.counts_numbers else 'categorical'
+    return 'float' if col_proc.value_type is float else 'int'
+
+def merge_columns(col_proc, other):
+    """Merge other into col_proc and return the result.
+
+    A column may have gone categorical in only one of the parts; the other
+    part is then made categorical too.
+    """
+    categorical = CategoricalColumnProcessor
+    if isinstance(other, categorical) and not isinstance(col_proc, categorical):
+        col_proc = categorical.from_numeric(col_proc)
+    elif isinstance(col_proc, categorical) and not isinstance(other, categorical):
+        other = categorical.from_numeric(other)
+    col_proc.merge(other)
+    return col_proc
+
+
 class FileProcessor:
-    def __init__(self, file_path):
+    """Reference engine: splits blocks of lines and feeds them column by column.
+
+    The type of every column is inferred from its first SAMPLE_ROWS values:
+    int and float columns get numeric processors of the chosen mode, which
+    convert each column batch at once, and other columns get categorical
+    frequency counts. An int column turns float on its first fractional
+    value, and a numeric column turns categorical on its first value that
+    is not a number.
+
+    With jobs > 1 the data part of the file is cut into newline-aligned byte
+    ranges which are processed by a pool of workers; each worker returns
+    its partial column processors and the parent merges them in file order.
+
+    With use_mmap the file is memory-mapped and rows are scanned in place:
+    only the fields of known columns are sliced out of the mapping.
+    """
+    COLUMN_PROCESSORS = {
+        'exact': ColumnProcessor,
+        'streaming': StreamingColumnProcessor,
+        'approx': ApproximateColumnProcessor,
+    }
+    CHUNK_SIZE = 1024 * 1024
+    RANGES_PER_JOB = 4
+    SAMPLE_ROWS = 10000
+
+    def __init__(self, file_path, mode='exact', processor_options=None,
+                 jobs=1, byte_range=None, use_mmap=False, column_types=None):
+        self.file_path = file_path
         self.file_name = os.path.basename(file_path)
         self.file = open(file_path, 'r')
+        self.mode = mode
+        self.processor_options = processor_options
+        self.jobs = jobs
+        self.use_mmap = use_mmap
 
-        self.column_processors = []
         column_names = self.file.readline()[:-1].split(',')
         self.column_count = len(column_names)
-        for column_name in column_names:
-            self.column_processors.append(ColumnProcessor(column_name))
+        self.data_start = self.file.tell()
+        self.column_types = column_types or self.__infer_column_types()
+        self.column_processors = [self._new_column_processor(column_name, column_type)
+                                  for column_name, column_type
+                                  in zip(column_names, self.column_types)]
 
         self.row_count = 0
 
+        self.start, self.end = byte_range or (None, None)
+        if self.start is None:
+            self.start = self.data_start
+        self.file.seek(self.start)
+
+        self.buffer = None
+        if use_mmap and os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
         self.process()
 
+    def _new_column_processor(self, column_name, column_type):
+        if column_type == 'categorical':
+            return CategoricalColumnProcessor(column_name)
 
-    def process(self):
+        processor_class = self.COLUMN_PROCESSORS[self.mode]
+        return processor_class(column_name, NUMERIC_TYPES[column_type],
+                               **(self.processor_options or {}))
+
+    def __infer_column_types(self):
+        lines = []
         for line in self.file:
-            column_values = line.split(',')
-            self.row_count += 1
-            for index in range(self.column_count):
-                self.column_processors[index].add_value(column_values[index])
+            lines.append(line)
+            if len(lines) >= self.SAMPLE_ROWS:
+                break
+        rows = [line.split(',') for line in ''.join(lines).splitlines()]
+
+        columns = zip(*rows) or [()] * self.column_count
+        column_types = [infer_column_type(values) for values in columns]
+        # short rows are reported by the processing pass
+        column_types += ['int'] * (self.column_count - len(column_types))
+        return column_types[:self.column_count]
+
+    def process(self):
+        if self.jobs > 1:
+            self.__process_parallel()
+            return
+
+        if self.buffer is not None:
+            end = len(self.buffer) if self.end is None else self.end
+            self._process_mapped(self.start, end)
+            return
+
+        for chunk in self._read_chunks():
+            self._process_chunk(chunk)
+
+    def _process_chunk(self, chunk):
+        rows = [line.split(',') for line in chunk.splitlines()]
+        self.row_count += len(rows)
+
+        # zip stops at the shortest row
+        columns = zip(*rows)
+        if rows and len(columns) < self.column_count:
+            raise IndexError("list index out of range")
+        self._add_columns(columns)
+
+    def _add_columns(self, columns):
+        if not columns:
+            return
+        for index, col_proc in enumerate(self.column_processors):
+            try:
+                col_proc.add_values(columns[index])
+            except ColumnTypeError:
+                # a value the type sample did not see
+                col_proc = CategoricalColumnProcessor.from_numeric(col_proc)
+                self.column_processors[index] = col_proc
+                col_proc.add_values(columns[index])
+
+    def _process_mapped(self, start, end):
+        """Scan the mapping in place, a block of lines at a time.
+
+        Only the fields of known columns are sliced out of the mapping:
+        no line strings or block copies. Each block's fields are handed
+        to the processors column by column.
+        """
+        buffer = self.buffer
+        find = buffer.find
+        last_index = self.column_count - 1
+
+        for position, block_end in self._mapped_blocks(start, end):
+            columns = [[] for index in range(self.column_count)]
+            appends = [column.append for column in columns]
+            while position < block_end:
+                line_end = find('\n', position, block_end)
+                next_line = line_end + 1
+                if line_end < 0:
+                    line_end = next_line = block_end
+                if line_end > position and buffer[line_end - 1] == '\r':
+                    line_end -= 1
+
+                self.row_count += 1
+                for index in range(self.column_count):
+                    field_end = find(',', position, line_end)
+                    if field_end < 0:
+                        if index < last_index:
+                            raise IndexError("list index out of range")
+                        field_end = line_end
+                    appends[index](buffer[position:field_end])
+                    position = field_end + 1
+
+                position = next_line
+            self._add_columns(columns)
+
+    def _mapped_blocks(self, start, end):
+        """Yield (start, end) of blocks of whole lines of the mapping."""
+        position = start
+        while position < end:
+            cut = min(position + self.CHUNK_SIZE, end)
+            if cut < end:
+                line_end = self.buffer.find('\n', cut, end)
+                cut = end if line_end < 0 else line_end + 1
+            yield position, cut
+            position = cut
+
+    def _read_chunks(self):
+        """Yield blocks of whole lines up to the end of the byte range."""
+        position = self.file.tell()
+        while self.end is None or position < self.end:
+            size = self.CHUNK_SIZE
+            if self.end is not None:
+                size = min(size, self.end - position)
+            chunk = self.file.read(size)
+            if not chunk:
+                break
+            if not chunk.endswith('\n'):
+                chunk += self.file.readline()
+            position += len(chunk)
+            yield chunk
+
+    def __process_parallel(self):
+        tasks = [(self.__class__, self.file_path, self.mode,
+                  self.processor_options, byte_range, self.use_mmap,
+                  self.column_types)
+                 for byte_range in self.__split_ranges(self.jobs * self.RANGES_PER_JOB)]
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            partials = pool.map(process_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for row_count, column_processors in partials:
+            self.row_count += row_count
+            self.column_processors = [
+                merge_columns(col_proc, partial)
+                for col_proc, partial in zip(self.column_processors, column_processors)]
+
+        self.file.seek(0, os.SEEK_END)
+
+    def __split_ranges(self, count):
+        file_size = os.path.getsize(self.file_path)
+        if self.end is not None:
+            file_size = min(file_size, self.end)
+        step = max(1, (file_size - self.start) / count)
+
+        boundaries = [self.start]
+        with open(self.file_path, 'rb') as range_file:
+            for index in range(1, count):
+                # the byte before the cut is either the end of the previous
+                # line or inside a line, which readline then skips over
+                range_file.seek(self.start + index * step - 1)
+                range_file.readline()
+                boundary = min(range_file.tell(), file_size)
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+        if file_size > boundaries[-1]:
+            boundaries.append(file_size)
+
+        return zip(boundaries[:-1], boundaries[1:])
 
     def print_stats(self):
         print "File {0} {1} rows, {2} cols.\n".format(self.file_name, self.row_count, self.column_count)
@@ -86,9 +901,303 @@ class FileProcessor:
         for col_proc in self.column_processors:
             col_proc.print_stats()
 
+
+def process_range(task):
+    """Pool worker: process one byte range, return its partial state."""
+    (engine_class, file_path, mode, processor_options, byte_range, use_mmap,
+     column_types) = task
+    file_processor = engine_class(file_path, mode, processor_options,
+                                  byte_range=byte_range, use_mmap=use_mmap,
+                                  column_types=column_types)
+    return file_processor.row_count, file_processor.column_processors
+
+
+class NumpyFileProcessor(FileProcessor):
+    """Columnar engine: parses large chunks of lines into typed NumPy arrays.
+
+    Each chunk is parsed by numpy in C as float64 ('None' becomes NaN, which
+    also serves as the None mask), converted to int64 and handed to the
+    column processors as whole arrays. FileProcessor stays the reference
+    implementation.
+    """
+    COLUMN_PROCESSORS = {
+        'exact': NumpyColumnProcessor,
+    }
+    CHUNK_SIZE = 16 * 1024 * 1024
+    # largest magnitude float64 represents exactly
+    EXACT_FLOAT_LIMIT = 2 ** 53
+
+    def __init__(self, file_path, mode='exact', processor_options=None,
+                 jobs=1, byte_range=None, use_mmap=False, column_types=None):
+        if np is None:
+            raise RuntimeError("numpy engine requires numpy to be installed")
+        if mode not in NumpyFileProcessor.COLUMN_PROCESSORS:
+            raise ValueError("numpy engine supports only {0} mode".format(
+                ', '.join(sorted(NumpyFileProcessor.COLUMN_PROCESSORS))))
+
+        FileProcessor.__init__(self, file_path, mode, processor_options,
+                               jobs, byte_range, use_mmap, column_types)
+
+    def _process_mapped(self, start, end):
+        # numpy parses text, so blocks are sliced out of the mapping
+        for block_start, block_end in self._mapped_blocks(start, end):
+            self._process_chunk(self.buffer[block_start:block_end])
+
+    def _new_column_processor(self, column_name, column_type):
+        if column_type == 'categorical':
+            raise ColumnTypeError("numpy engine supports only numeric columns, "
+                                  "{0} is categorical".format(column_name))
+
+        return FileProcessor._new_column_processor(self, column_name, column_type)
+
+    def _process_chunk(self, chunk):
+        lines = chunk.splitlines()
+        self.row_count += len(lines)
+
+        table = self.__parse_lines(lines)
+        undefined = np.isnan(table)
+
+        for index in range(self.column_count):
+            col_proc = self.column_processors[index]
+            column = table[:, index]
+            column_undefined = undefined[:, index]
+            known = column[~column_undefined]
+            col_proc.add_chunk(known, int(column_undefined.sum()))
+            if col_proc.value_type is int and \
+                    (np.abs(known) > self.EXACT_FLOAT_LIMIT).any():
+                raise ValueError("{0}: int values beyond +-2**53 are not supported "
+                                 "by numpy engine".format(self.file_name))
+
+    def __parse_lines(self, lines):
+        text = ','.join(lines).replace('None', 'nan')
+        table = np.fromstring(text, dtype=np.float64, sep=',')
+
+        # fromstring silently stops at the first malformed field
+        if table.size != len(lines) * self.column_count:
+            self.__check_fields(lines)
+            raise ValueError("{0}: malformed rows in chunk ending at row {1}".format(
+                self.file_name, self.row_count))
+
+        return table.reshape(len(lines), self.column_count)
+
+    def __check_fields(self, lines):
+        """Raise ColumnTypeError for the first field that is not a number."""
+        for line in lines:
+            fields = line.split(',')
+            if len(fields) != self.column_count:
+                return
+            for col_proc, field in zip(self.column_processors, fields):
+                if field == UNDEFINED_VALUE:
+                    continue
+                try:
+                    float(field)
+                except ValueError:
+                    raise ColumnTypeError(
+                        "numpy engine supports only numeric columns, {0} has "
+                        "the value {1!r}".format(col_proc.column_name, field))
+
+class StatisticsCache:
+    """On-disk cache of column state for files that are only appended to.
+
+    An entry is stored per (path, engine, mode, options) and records the
+    inode, mtime and size of the file, the byte offset processed so far,
+    digests of the first and last bytes before that offset and the pickled
+    column processors. On the next run only the tail after the offset is
+    processed and merged in. A different inode, a file shorter than the
+    offset or a digest mismatch means the file was truncated or rewritten,
+    and the entry is discarded.
+
+    A last line without a newline may still be written to, so it is left
+    out of the entry, but it is still counted in the returned result.
+    """
+    DIGEST_SIZE = 4096
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def process(self, engine_class, file_path, mode='exact',
+                processor_options=None, jobs=1, use_mmap=False):
+        entry_path = self.__entry_path(engine_class, file_path, mode,
+                                       processor_options)
+        file_stat = os.stat(file_path)
+        # a partially written last line is not cached
+        end = self.__last_line_end(file_path, file_stat.st_size)
+
+        entry = self.__load(entry_path)
+        if entry is not None and not self.__is_valid(entry, file_path, file_stat):
+            entry = None
+
+        start, column_types = None, None
+        if entry is not None:
+            start = entry['offset']
+            # the tail is typed like the cached part, not from the file head
+            column_types = [column_type(col_proc)
+                            for col_proc in entry['column_processors']]
+        file_processor = engine_class(file_path, mode, processor_options, jobs,
+                                      byte_range=(start, end), use_mmap=use_mmap,
+                                      column_types=column_types)
+
+        if entry is not None:
+            file_processor.column_processors = [
+                merge_columns(col_proc, tail) for col_proc, tail
+                in zip(entry['column_processors'], file_processor.column_processors)]
+            file_processor.row_count += entry['row_count']
+
+        offset = max(end, file_processor.start)
+        self.__store(entry_path, {
+            'path': os.path.abspath(file_path),
+            'inode': (file_stat.st_dev, file_stat.st_ino),
+            'mtime': file_stat.st_mtime,
+            'size': file_stat.st_size,
+            'offset': offset,
+            'digests': self.__digests(file_path, offset),
+            'row_count': file_processor.row_count,
+            'column_processors': file_processor.column_processors,
+        })
+
+        if offset < file_stat.st_size:
+            # the entry is stored already: the last line is merged into
+            # the printed result only
+            last_line = engine_class(
+                file_path, mode, processor_options,
+                byte_range=(offset, file_stat.st_size), use_mmap=use_mmap,
+                column_types=map(column_type, file_processor.column_processors))
+            file_processor.column_processors = [
+                merge_columns(col_proc, tail) for col_proc, tail
+                in zip(file_processor.column_processors, last_line.column_processors)]
+            file_processor.row_count += last_line.row_count
+
+        return file_processor
+
+    def __is_valid(self, entry, file_path, file_stat):
+        if entry['inode'] != (file_stat.st_dev, file_stat.st_ino):
+            return False
+        if file_stat.st_size < entry['offset']:
+            return False
+        if (file_stat.st_mtime, file_stat.st_size) == (entry['mtime'], entry['size']):
+            return True
+
+        return self.__digests(file_path, entry['offset']) == entry['digests']
+
+    def __digests(self, file_path, offset):
+        with open(file_path, 'rb') as data_file:
+            head = data_file.read(min(offset, self.DIGEST_SIZE))
+            tail_start = max(0, offset - self.DIGEST_SIZE)
+            data_file.seek(tail_start)
+            tail = data_file.read(offset - tail_start)
+
+        return hashlib.md5(head).hexdigest(), hashlib.md5(tail).hexdigest()
+
+    def __last_line_end(self, file_path, file_size):
+        with open(file_path, 'rb') as data_file:
+            position = file_size
+            while position > 0:
+                block_start = max(0, position - self.DIGEST_SIZE)
+                data_file.seek(block_start)
+                newline = data_file.read(position - block_start).rfind('\n')
+                if newline >= 0:
+                    return block_start + newline + 1
+                position = block_start
+
+        return 0
+
+    def __entry_path(self, engine_class, file_path, mode, processor_options):
+        key = repr((os.path.abspath(file_path), engine_class.__name__, mode,
+                    sorted((processor_options or {}).items())))
+        return os.path.join(self.cache_dir, hashlib.md5(key).hexdigest() + '.pickle')
+
+    def __load(self, entry_path):
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path, 'rb') as entry_file:
+            return pickle.load(entry_file)
+
+    def __store(self, entry_path, entry):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        temp_path = entry_path + '.tmp'
+        with open(temp_path, 'wb') as entry_file:
+            pickle.dump(entry, entry_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, entry_path)
+
+ENGINES = {
+    'python': FileProcessor,
+    'numpy': NumpyFileProcessor,
+}
+
 if __name__ == "__main__":
-    file_path = sys.argv[1]
+    parser = OptionParser(usage='%prog [options] <file>')
+    parser.add_option('-m', '--mode', type='choice',
+                      action='store', dest='mode',
+                      choices=sorted(FileProcessor.COLUMN_PROCESSORS),
+                      help='statistics mode: \'exact\' keeps every value, '
+                           '\'streaming\' keeps running accumulators and '
+                           'a count per distinct value (memory grows with '
+                           'the number of distinct values), \'approx\' '
+                           'uses fixed-size sketches',
+                      default='exact')
+    parser.add_option('-e', '--engine', type='choice',
+                      action='store', dest='engine',
+                      choices=sorted(ENGINES),
+                      help='ingestion engine: \'python\' splits line by line, '
+                           '\'numpy\' parses large chunks into arrays '
+                           '(exact mode only)',
+                      default='python')
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      dest='jobs', default=1,
+                      help='number of worker processes')
+    parser.add_option('--mmap', action='store_true', dest='use_mmap',
+                      default=False,
+                      help='memory-map the input and scan it in place: '
+                           'no block copies, but slower than reading '
+                           'blocks with the python engine')
+    parser.add_option('--cache', action='store_true', dest='use_cache',
+                      default=False,
+                      help='reuse statistics of the already processed part '
+                           'of an append-only file')
+    parser.add_option('--cache-dir', metavar='DIR', dest='cache_dir',
+                      default='.task2_cache',
+                      help='where --cache keeps its entries')
+    parser.add_option('--quantile-error', type='float', metavar='EPS',
+                      dest='quantile_error', default=0.01,
+                      help='approx mode: rank error of median and percentiles')
+    parser.add_option('--uniq-error', type='float', metavar='EPS',
+                      dest='uniq_error', default=0.01,
+                      help='approx mode: relative error of unique count')
+    parser.add_option('--percentiles', metavar='P1,P2,...',
+                      dest='percentiles', default='',
+                      help='approx mode: extra percentiles to report')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.print_help()
+        exit(-1)
+    if options.mode not in ENGINES[options.engine].COLUMN_PROCESSORS:
+        parser.error("{0} engine supports only {1} mode".format(
+            options.engine, ', '.join(sorted(ENGINES[options.engine].COLUMN_PROCESSORS))))
 
-    file_processor = FileProcessor(file_path)
-    file_processor.process()
+    file_path = args[0]
+
+    processor_options = None
+    if options.mode == 'approx':
+        processor_options = {
+            'quantile_error': options.quantile_error,
+            'uniq_error': options.uniq_error,
+            'percentiles': [float(p) for p in options.percentiles.split(',') if p],
+        }
+
+    try:
+        if options.use_cache:
+            file_processor = StatisticsCache(options.cache_dir).process(
+                ENGINES[options.engine], file_path, options.mode,
+                processor_options, options.jobs, options.use_mmap)
+        else:
+            file_processor = ENGINES[options.engine](file_path, options.mode,
+                                                     processor_options, options.jobs,
+                                                     use_mmap=options.use_mmap)
+    except ColumnTypeError as error:
+        # only the numpy engine cannot turn a column categorical
+        print "{0}: {1}, use -e python".format(file_path, error)
+        exit(-1)
     file_processor.print_stats()
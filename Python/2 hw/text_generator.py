@@ -1,13 +1,24 @@
 import re
 import sys
 import random
-import operator
-import pickle
+import bisect
+import struct
+import mmap
 import os
-import functools
 import time
+import json
+import hashlib
+import operator
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
+from array import array
 from optparse import OptionParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import instrument
+
 
 def words(sentence):
     r = re.compile(r"(((The|the|A|a|An|an) )?[\w']+)")
@@ -22,238 +33,1265 @@ def sentences(fileobj):
             yield word
 
 
-class FrequencyCounter:
-    def __init__(self):
-        self.words = dict()
+# a word (with its article) or a sentence terminator, which has no group
+TOKEN_PATTERN = re.compile(r"((?:(?:The|the|A|a|An|an) )?[\w']+)|[\.!\?;]")
+TOKEN_CHUNK_SIZE = 4 * 1024 * 1024
+
 
-    def add_word(self, key):
-        if key not in self.words:
-            self.words[key] = 0
+def tokens(fileobj, chunk_size=TOKEN_CHUNK_SIZE):
+    """Batches of words of a text, None marks a sentence end.
 
-        self.words[key] += 1
+    The text is scanned once, in large chunks cut after the last line
+    break: no token spans a line break, while sentences may.
+    """
+    tail = ''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
 
-    def get_most_frequent(self):
-        return max(self.words.iteritems(), key=operator.itemgetter(1))[0]
+        text = tail + chunk
+        cut = text.rfind('\n') + 1
+        tail = text[cut:]
+        if cut:
+            yield [match.group(1) for match in TOKEN_PATTERN.finditer(text, 0, cut)]
 
+    if tail:
+        yield [match.group(1) for match in TOKEN_PATTERN.finditer(tail)]
+
+
+class Vocabulary(object):
+    """Interns words to consecutive integer ids."""
+    __slots__ = ('__ids', '__words')
 
-class NgramStatistics:
     def __init__(self):
-        self.__ngrams = dict()
+        self.__ids = dict()
+        self.__words = list()
 
-    def add_ngram(self, *args):
-        key = args[:-1]
-        if key not in self.__ngrams:
-            self.__ngrams[key] = FrequencyCounter()
+    def add(self, word):
+        word_id = self.__ids.get(word)
+        if word_id is None:
+            word_id = len(self.__words)
+            self.__ids[word] = word_id
+            self.__words.append(word)
 
-        self.__ngrams[key].add_word(args[-1])
+        return word_id
 
-    def get_next_for(self, key):
-        if key not in self.__ngrams:
+    def extend(self, other):
+        """Add every word of another vocabulary, returning their ids here."""
+        new_words = list(itertools.ifilterfalse(self.__ids.__contains__, other))
+        self.__ids.update(itertools.izip(new_words, itertools.count(len(self.__words))))
+        self.__words.extend(new_words)
+
+        return array('i', map(self.__ids.__getitem__, other))
+
+    def get_id(self, word):
+        return self.__ids.get(word)
+
+    def get_word(self, word_id):
+        return self.__words[word_id]
+
+    def sections(self):
+        offsets = array('l', [0])
+        for word in self.__words:
+            offsets.append(offsets[-1] + len(word))
+        by_word = sorted(xrange(len(self.__words)), key=self.__words.__getitem__)
+
+        return [('vocabulary.offsets', offsets),
+                ('vocabulary.blob', array('B', ''.join(self.__words))),
+                ('vocabulary.sorted', array('i', by_word))]
+
+    def __len__(self):
+        return len(self.__words)
+
+    def __iter__(self):
+        return iter(self.__words)
+
+
+class MappedVocabulary(object):
+    """Read-only Vocabulary over the sections of a ModelFile.
+
+    Words are sliced out of the blob on demand; word -> id is a binary
+    search over ids sorted by word.
+    """
+    __slots__ = ('__offsets', '__blob', '__sorted')
+
+    def __init__(self, model):
+        self.__offsets = model.array('vocabulary.offsets')
+        self.__blob = model.array('vocabulary.blob')
+        self.__sorted = model.array('vocabulary.sorted')
+
+    def get_id(self, word):
+        index = bisect.bisect_left(_SortedWords(self), word)
+        if index == len(self.__sorted):
             return None
 
-        return self.__ngrams[key].get_most_frequent()
+        word_id = self.__sorted[index]
+        if self.get_word(word_id) != word:
+            return None
 
+        return word_id
 
-class StatisticsEngine:
-    dump_file_path = "dump.pickle"
+    def get_word(self, word_id):
+        return self.__blob.raw(self.__offsets[word_id], self.__offsets[word_id + 1])
 
-    def __init__(self):
-        self.__2grams = NgramStatistics()
-        self.__3grams = NgramStatistics()
-        self.__open_words = list()
-        self.__all_words = list()
+    def get_sorted_word(self, index):
+        return self.get_word(self.__sorted[index])
 
-        self.__prelast_word = None
-        self.__last_word = None
+    def __len__(self):
+        return len(self.__sorted)
 
-        self.__last_open_word = None
+    def __iter__(self):
+        for word_id in xrange(len(self)):
+            yield self.get_word(word_id)
 
-    def add_word(self, word):
 
-        if self.__prelast_word is None:
-            self.__open_words.append(word)
-            self.__prelast_word = word
+class _SortedWords(object):
+    """Sequence view of a MappedVocabulary in word order, for bisect."""
+    __slots__ = ('vocabulary',)
 
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, index):
+        return self.vocabulary.get_sorted_word(index)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+
+class NgramStatistics(object):
+    """Successor counts of n-grams over word ids.
+
+    While learning, counts live in a dict keyed by the n-gram ids packed
+    into one int. compact() turns them into a trie of flat arrays: level i
+    holds the i-th ids of all distinct n-gram prefixes, sorted within their
+    parent, and starts[i] gives the range of each node's children in level
+    i + 1. The last level holds successor ids, with counts alongside.
+
+    finalize() precomputes what generation needs: the most frequent
+    successor of every context, an open-addressing hash index from context
+    to its trie node, so lookups take constant time, and optionally Vose
+    alias tables for sampling successors proportionally to their counts.
+    """
+    __slots__ = ('order', '__pending', '__levels', '__starts', '__counts',
+                 '__parents', '__best', '__slots', '__slot_bits',
+                 '__alias_probability', '__alias_index')
+    ID_BITS = 32
+    HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+    HASH_MASK = (1 << 64) - 1
+    EMPTY_SLOT = -1
+
+    def __init__(self, order):
+        self.order = order
+        self.__pending = dict()
+        self.__levels = [array('i') for level in range(order)]
+        self.__starts = [array('l', [0]) for level in range(order - 1)]
+        self.__counts = array('I')
+        self.__reset_index()
+
+    def add_ngram(self, *args):
+        self.add_count(args, 1)
+
+    def add_count(self, ngram, count):
+        key = self.__pack(ngram)
+        self.__pending[key] = self.__pending.get(key, 0) + count
+
+    def merge(self, other, ids):
+        """Add other's counts, other's word ids mapped through ids.
+
+        Other's trie is remapped a level at a time and every node's shifted
+        key is repeated for its children, so keys are built by C-level maps
+        without a Python loop over the n-grams.
+        """
+        other.compact()
+        if not len(other.__counts):
             return
 
-        self.__all_words.append(word)
+        keys = map(ids.__getitem__, other.__levels[0])
+        for level in range(1, self.order):
+            starts = other.__starts[level - 1]
+            children = map(operator.sub, starts[1:], starts[:-1])
+            shifted = itertools.imap(operator.lshift, keys,
+                                     itertools.repeat(self.ID_BITS))
+            prefixes = itertools.chain.from_iterable(
+                itertools.imap(itertools.repeat, shifted, children))
+            keys = map(operator.or_, prefixes,
+                       itertools.imap(ids.__getitem__, other.__levels[level]))
+
+        pending = self.__pending
+        common = filter(pending.__contains__, keys)
+        common_counts = map(pending.__getitem__, common)
+        pending.update(itertools.izip(keys, other.__counts))
+        pending.update(itertools.izip(common, map(
+            operator.add, map(pending.__getitem__, common), common_counts)))
+
+    def get_next_for(self, key):
+        if self.__best is None:
+            self.finalize()
+
+        node = self.__find_context(key)
+        if node is None:
+            return None
+
+        return self.__best[node]
+
+    def sample_next_for(self, key, rng=random):
+        if self.__alias_probability is None:
+            self.finalize(alias=True)
 
-        if self.__last_word is None:
-            self.__2grams.add_ngram(self.__prelast_word, word)
-            self.__last_word = word
+        node = self.__find_context(key)
+        if node is None:
+            return None
+
+        lo, hi = self.__starts[-1][node], self.__starts[-1][node + 1]
+        index = lo + int(rng.random() * (hi - lo))
+        if rng.random() >= self.__alias_probability[index]:
+            index = self.__alias_index[index]
+
+        return self.__levels[-1][index]
+
+    def finalize(self, alias=False):
+        self.compact()
+
+        if self.__best is None:
+            self.__build_parents()
+            self.__build_best()
+            self.__build_slots()
+        if alias and self.__alias_probability is None:
+            if not self.can_sample():
+                raise ValueError("model has no alias tables, relearn it with --sampling")
+            self.__build_alias()
+
+    def can_sample(self):
+        """Whether alias tables exist or can be built in memory.
+
+        Building them over a mapped model would decode it whole on every
+        start, so mapped statistics only sample with stored tables.
+        """
+        return self.__alias_probability is not None or \
+            not isinstance(self.__counts, MappedArray)
+
+    def prune(self, min_count=1, top_k=None):
+        """Drop rare n-grams and keep only the top_k successors per context."""
+        if min_count <= 1 and top_k is None:
+            return
 
+        kept = dict()
+        by_context = itertools.groupby(self.iteritems(), lambda item: item[0][:-1])
+        for context, items in by_context:
+            items = [item for item in items if item[1] >= min_count]
+            if top_k is not None:
+                # sorted is stable: ties keep the lower successor id
+                items = sorted(items, key=lambda item: -item[1])[:top_k]
+            for ngram, count in items:
+                kept[self.__pack(ngram)] = count
+
+        self.__levels = [array('i') for level in range(self.order)]
+        self.__starts = [array('l', [0]) for level in range(self.order - 1)]
+        self.__counts = array('I')
+        self.__pending = kept
+        self.__reset_index()
+        self.compact()
+
+    def context_count(self):
+        self.compact()
+        return len(self.__starts[-1]) - 1
+
+    def memory_usage(self):
+        """Bytes taken by the arrays held in memory."""
+        arrays = self.__levels + self.__starts + (self.__parents or [None])[1:] + \
+            [self.__counts, self.__best, self.__slots,
+             self.__alias_probability, self.__alias_index]
+        return sum(len(values) * values.itemsize for values in arrays
+                   if isinstance(values, array))
+
+    def compact(self):
+        if not self.__pending:
             return
 
-        self.__2grams.add_ngram(self.__last_word, word)
-        self.__3grams.add_ngram(self.__prelast_word, self.__last_word, word)
+        self.__reset_index()
+
+        counts = self.__pending
+        for ngram, count in self.__iter_compacted():
+            key = self.__pack(ngram)
+            counts[key] = counts.get(key, 0) + count
+
+        levels = [array('i') for level in range(self.order)]
+        starts = [array('l') for level in range(self.order - 1)]
+        compact_counts = array('I')
+
+        mask = (1 << self.ID_BITS) - 1
+        shifts = [self.ID_BITS * (self.order - level - 1)
+                  for level in range(self.order)]
+        previous = None
+        for key in sorted(counts):
+            ngram = [(key >> shift) & mask for shift in shifts]
+
+            # levels above the first differing id share the previous nodes
+            depth = 0
+            if previous is not None:
+                while ngram[depth] == previous[depth]:
+                    depth += 1
+            for level in range(depth, self.order):
+                if level < self.order - 1:
+                    starts[level].append(len(levels[level + 1]))
+                levels[level].append(ngram[level])
+
+            compact_counts.append(counts[key])
+            previous = ngram
+
+        for level in range(self.order - 1):
+            starts[level].append(len(levels[level + 1]))
+
+        self.__levels = levels
+        self.__starts = starts
+        self.__counts = compact_counts
+        self.__pending = dict()
+
+    def sections(self, prefix):
+        self.finalize()
+
+        sections = [(prefix + 'counts', self.__counts),
+                    (prefix + 'best', self.__best),
+                    (prefix + 'slots', self.__slots)]
+        for level in range(self.order):
+            sections.append((prefix + 'level{0}'.format(level), self.__levels[level]))
+        for level in range(self.order - 1):
+            sections.append((prefix + 'starts{0}'.format(level), self.__starts[level]))
+        for level in range(1, self.order - 1):
+            sections.append((prefix + 'parents{0}'.format(level), self.__parents[level]))
+        if self.__alias_probability is not None:
+            sections.append((prefix + 'alias_probability', self.__alias_probability))
+            sections.append((prefix + 'alias_index', self.__alias_index))
+
+        return sections
 
-        self.__last_word = self.__prelast_word
-        self.__prelast_word = word
+    @classmethod
+    def from_model(cls, model, prefix, order):
+        """Build finalized statistics whose arrays are views into model."""
+        ngrams = cls(order)
+        ngrams.__counts = model.array(prefix + 'counts')
+        ngrams.__best = model.array(prefix + 'best')
+        ngrams.__slots = model.array(prefix + 'slots')
+        ngrams.__slot_bits = len(ngrams.__slots).bit_length() - 1
+        ngrams.__levels = [model.array(prefix + 'level{0}'.format(level))
+                           for level in range(order)]
+        ngrams.__starts = [model.array(prefix + 'starts{0}'.format(level))
+                           for level in range(order - 1)]
+        ngrams.__parents = [None] + [model.array(prefix + 'parents{0}'.format(level))
+                                     for level in range(1, order - 1)]
+        if prefix + 'alias_probability' in model:
+            ngrams.__alias_probability = model.array(prefix + 'alias_probability')
+            ngrams.__alias_index = model.array(prefix + 'alias_index')
+
+        return ngrams
+
+    def thaw(self):
+        """Copy arrays mapped by from_model into memory, so counts can grow."""
+        self.__levels = [_copy_array(level, 'i') for level in self.__levels]
+        self.__starts = [_copy_array(starts, 'l') for starts in self.__starts]
+        self.__counts = _copy_array(self.__counts, 'I')
+        self.__reset_index()
+
+    def iteritems(self):
+        """Yield (ngram, count) pairs in id order."""
+        self.compact()
+        return self.__iter_compacted()
+
+    def __len__(self):
+        self.compact()
+        return len(self.__counts)
+
+    def __pack(self, ngram):
+        key = 0
+        for word_id in ngram:
+            key = (key << self.ID_BITS) | word_id
+
+        return key
+
+    def __reset_index(self):
+        self.__parents = None
+        self.__best = None
+        self.__slots = None
+        self.__slot_bits = 0
+        self.__alias_probability = None
+        self.__alias_index = None
+
+    def __hash_slot(self, context):
+        hashed = (self.__pack(context) * self.HASH_MULTIPLIER) & self.HASH_MASK
+        return hashed >> (64 - self.__slot_bits)
+
+    def __find_context(self, context):
+        if len(context) != self.order - 1:
+            return None
+
+        slots = self.__slots
+        mask = len(slots) - 1
+        slot = self.__hash_slot(context)
+        while slots[slot] != self.EMPTY_SLOT:
+            node = slots[slot]
+            if self.__context_of(node) == tuple(context):
+                return node
+            slot = (slot + 1) & mask
+
+        return None
+
+    def __context_of(self, node):
+        context_level = self.order - 2
+        context = [self.__levels[context_level][node]]
+        for level in range(context_level, 0, -1):
+            node = self.__parents[level][node]
+            context.append(self.__levels[level - 1][node])
+        context.reverse()
+
+        return tuple(context)
+
+    def __build_parents(self):
+        # parents[level][node] is the index of node's parent in level - 1
+        self.__parents = [None]
+        for level in range(1, self.order - 1):
+            parents = array('i')
+            starts = self.__starts[level - 1]
+            for parent in xrange(len(starts) - 1):
+                parents.extend([parent] * (starts[parent + 1] - starts[parent]))
+            self.__parents.append(parents)
+
+    def __build_best(self):
+        counts = self.__counts
+        successors = self.__levels[-1]
+        starts = self.__starts[-1]
+
+        self.__best = array('i')
+        for node in xrange(len(starts) - 1):
+            best = starts[node]
+            for index in xrange(best + 1, starts[node + 1]):
+                if counts[index] > counts[best]:
+                    best = index
+            self.__best.append(successors[best])
+
+    def __build_slots(self):
+        context_count = len(self.__starts[-1]) - 1
+        self.__slot_bits = max(3, (2 * context_count).bit_length())
+        self.__slots = array('i', [self.EMPTY_SLOT]) * (1 << self.__slot_bits)
+
+        mask = len(self.__slots) - 1
+        for node in xrange(context_count):
+            slot = self.__hash_slot(self.__context_of(node))
+            while self.__slots[slot] != self.EMPTY_SLOT:
+                slot = (slot + 1) & mask
+            self.__slots[slot] = node
+
+    def __build_alias(self):
+        counts = self.__counts
+        starts = self.__starts[-1]
+        self.__alias_probability = array('d', [1.0]) * len(counts)
+        self.__alias_index = array('i', xrange(len(counts)))
+
+        for node in xrange(len(starts) - 1):
+            lo, hi = starts[node], starts[node + 1]
+            size = hi - lo
+            total = float(sum(counts[lo:hi]))
+            scaled = [counts[index] * size / total for index in xrange(lo, hi)]
+            small = [index for index in xrange(size) if scaled[index] < 1.0]
+            large = [index for index in xrange(size) if scaled[index] >= 1.0]
+
+            while small and large:
+                less, more = small.pop(), large.pop()
+                self.__alias_probability[lo + less] = scaled[less]
+                self.__alias_index[lo + less] = lo + more
+                scaled[more] += scaled[less] - 1.0
+                if scaled[more] < 1.0:
+                    small.append(more)
+                else:
+                    large.append(more)
+
+    def __iter_compacted(self, level=0, lo=0, hi=None, prefix=()):
+        if hi is None:
+            hi = len(self.__levels[0])
+        ids = self.__levels[level]
+        for index in xrange(lo, hi):
+            ngram = prefix + (ids[index],)
+            if level == self.order - 1:
+                yield ngram, self.__counts[index]
+            else:
+                for item in self.__iter_compacted(level + 1,
+                                                  self.__starts[level][index],
+                                                  self.__starts[level][index + 1],
+                                                  ngram):
+                    yield item
+
+
+class MappedArray(object):
+    """Read-only sequence view of one array stored in a ModelFile."""
+    __slots__ = ('__buffer', '__struct', '__offset', '__length')
+
+    def __init__(self, buffer, element_format, offset, length):
+        self.__buffer = buffer
+        self.__struct = struct.Struct('<' + element_format)
+        self.__offset = offset
+        self.__length = length
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.__length))]
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError("model array index out of range")
+
+        return self.__struct.unpack_from(
+            self.__buffer, self.__offset + index * self.__struct.size)[0]
+
+    def __iter__(self):
+        for index in xrange(self.__length):
+            yield self[index]
+
+    def raw(self, start, stop):
+        size = self.__struct.size
+        return self.__buffer[self.__offset + start * size:self.__offset + stop * size]
+
+    def copy(self, typecode):
+        """Decode the whole view into an array.array of typecode."""
+        values = array(typecode)
+        if values.itemsize != self.__struct.size:
+            values.extend(self)
+            return values
+
+        values.fromstring(self.raw(0, self.__length))
+        if sys.byteorder != 'little':
+            values.byteswap()
+
+        return values
+
+
+def _copy_array(values, typecode):
+    if isinstance(values, MappedArray):
+        return values.copy(typecode)
+
+    return values
+
+
+class ModelFile(object):
+    """Versioned binary model: a directory of named flat arrays.
+
+    Layout: header (magic, version, array count), one directory entry per
+    array (name, element format, length, offset), then the array data, each
+    aligned to 8 bytes. Numbers are little-endian. The file is mapped
+    read-only and arrays are decoded element by element on access, so
+    opening a model costs the same whatever its size, and processes using
+    the same model share its pages.
+    """
+    MAGIC = 'TGMODEL\0'
+    VERSION = 2
+    HEADER = struct.Struct('<8sII')
+    ENTRY = struct.Struct('<32scQQ')
+    ALIGNMENT = 8
+    # struct element format per (array typecode, itemsize)
+    FORMATS = {('i', 4): 'i', ('l', 4): 'i', ('l', 8): 'q', ('I', 4): 'I',
+               ('d', 8): 'd', ('B', 1): 'B'}
+
+    def __init__(self, path):
+        self.__file = open(path, 'rb')
+        self.__buffer = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.__buffer) < self.HEADER.size:
+            raise ValueError("{0} is not a model file".format(path))
+        magic, version, count = self.HEADER.unpack_from(self.__buffer, 0)
+        if magic != self.MAGIC:
+            raise ValueError("{0} is not a model file".format(path))
+        if version != self.VERSION:
+            raise ValueError("{0}: unsupported model version {1}".format(path, version))
+
+        self.__entries = dict()
+        for index in range(count):
+            name, element_format, length, offset = self.ENTRY.unpack_from(
+                self.__buffer, self.HEADER.size + index * self.ENTRY.size)
+            self.__entries[name.rstrip('\0')] = (element_format, offset, length)
+
+    def __contains__(self, name):
+        return name in self.__entries
+
+    def array(self, name):
+        element_format, offset, length = self.__entries[name]
+        return MappedArray(self.__buffer, element_format, offset, length)
+
+    @classmethod
+    def write(cls, path, sections):
+        """Write (name, array) sections to path, replacing it atomically."""
+        offset = cls.__align(cls.HEADER.size + len(sections) * cls.ENTRY.size)
+        entries = []
+        for name, values in sections:
+            element_format = cls.FORMATS[(values.typecode, values.itemsize)]
+            entries.append(cls.ENTRY.pack(name, element_format, len(values), offset))
+            offset = cls.__align(offset + len(values) * values.itemsize)
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as model_file:
+            model_file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(sections)))
+            model_file.write(''.join(entries))
+            for name, values in sections:
+                model_file.write('\0' * (cls.__align(model_file.tell()) - model_file.tell()))
+                if sys.byteorder != 'little':
+                    values = array(values.typecode, values)
+                    values.byteswap()
+                model_file.write(values.tostring())
+        os.rename(temp_path, path)
+
+    @classmethod
+    def __align(cls, offset):
+        return (offset + cls.ALIGNMENT - 1) // cls.ALIGNMENT * cls.ALIGNMENT
+
+
+class StatisticsEngine:
+    """Order-N n-gram model.
+
+    A ring buffer of the last order - 1 words of the current sentence feeds
+    one NgramStatistics table per order 2..N. Sentence ends are learned as
+    the END_OF_SENTENCE successor, so a context that usually closes a
+    sentence predicts it. Lookups back off from the longest context to
+    shorter ones; order 1 is get_next_random, the unigram distribution.
+    """
+    dump_file_path = "dump.model"
+    # never produced by the tokenizer, so it cannot clash with a word
+    END_OF_SENTENCE = '\n'
+
+    def __init__(self, order=3):
+        if order < 2:
+            raise ValueError("n-gram order must be at least 2")
+
+        self.order = order
+        self.__vocabulary = Vocabulary()
+        self.__end_id = self.__vocabulary.add(self.END_OF_SENTENCE)
+        # self.__ngrams[n - 2] holds the n-grams
+        self.__ngrams = [NgramStatistics(n) for n in range(2, order + 1)]
+        self.__open_words = array('i')
+        self.__all_words = array('i')
+
+        self.__context = collections.deque(maxlen=order - 1)
+
+        # path -> (size, mtime, md5) of every learned file
+        self.__sources = dict()
+
+    def add_word(self, word):
+        word = self.__vocabulary.add(word)
+
+        if not self.__context:
+            self.__open_words.append(word)
+        else:
+            self.__all_words.append(word)
+            self.__add_ngrams(word)
+
+        self.__context.append(word)
 
     def end_sentence(self):
-        self.__prelast_word = None
-        self.__last_word = None
+        if self.__context:
+            self.__add_ngrams(self.__end_id)
+        self.__context.clear()
+
+    def add_tokens(self, tokens):
+        """Learn a batch of words, None ends a sentence."""
+        add_word = self.add_word
+        end_sentence = self.end_sentence
+        for token in tokens:
+            if token is None:
+                end_sentence()
+            else:
+                add_word(token)
+
+    def __add_ngrams(self, word):
+        context = tuple(self.__context)
+        for length in range(1, len(context) + 1):
+            self.__ngrams[length - 1].add_ngram(*(context[-length:] + (word,)))
 
-    def get_open_word(self):
-        open_word = random.choice(self.__open_words)
+    def get_open_word(self, rng=random, previous=None):
+        """Random sentence opener, different from previous if possible."""
+        open_word = self.__vocabulary.get_word(rng.choice(self.__open_words))
 
         if len(self.__open_words) == 1:
             return open_word
 
-        while open_word == self.__last_open_word:
-            open_word = random.choice(self.__open_words)
-
-        self.__last_open_word = open_word
+        while open_word == previous:
+            open_word = self.__vocabulary.get_word(rng.choice(self.__open_words))
 
         return open_word
 
     def get_next_for(self, *args):
-        next_word = None
+        """Most frequent successor of the words, None at a sentence end."""
+        return self.__backoff(args, lambda ngrams, key: ngrams.get_next_for(key))
+
+    def sample_next_for(self, words, rng=random):
+        """Like get_next_for, but draws successors in proportion to counts."""
+        return self.__backoff(words, lambda ngrams, key: ngrams.sample_next_for(key, rng))
+
+    def __backoff(self, words, lookup):
+        key = tuple(self.__vocabulary.get_id(word) for word in words)
+
+        for length in range(min(len(key), self.order - 1), 0, -1):
+            context = key[-length:]
+            if None in context:
+                continue
 
-        if len(args) == 1:
-            next_word = self.__2grams.get_next_for(args)
+            next_word = lookup(self.__ngrams[length - 1], context)
+            if next_word is None:
+                continue
+            if next_word == self.__end_id:
+                return None
+
+            return self.__vocabulary.get_word(next_word)
+
+        return None
+
+    def finalize(self, alias=False, min_count=1, top_k=None):
+        """Prune, then precompute successor lookups.
+
+        N-grams seen fewer than min_count times are dropped and only the
+        top_k most frequent successors of each context are kept; alias
+        tables are for sampling.
+        """
+        for ngrams in self.__ngrams:
+            ngrams.prune(min_count, top_k)
+            ngrams.finalize(alias)
+
+    def can_sample(self):
+        return all(ngrams.can_sample() for ngrams in self.__ngrams)
+
+    def memory_report(self):
+        """(order, n-grams, contexts, bytes) of every table."""
+        return [(ngrams.order, len(ngrams), ngrams.context_count(),
+                 ngrams.memory_usage())
+                for ngrams in self.__ngrams]
+
+    def get_next_random(self, rng=random):
+        return self.__vocabulary.get_word(rng.choice(self.__all_words))
+
+    def merge(self, other):
+        """Add other's statistics as if its text was learned after ours.
 
-        if len(args) == 2:
-            next_word = self.__3grams.get_next_for(args) or \
-                        self.__2grams.get_next_for(args[-1])
+        Other's word ids are remapped through our vocabulary in other's id
+        order, so merging shards in text order assigns the same ids, counts
+        and pools as learning the whole text sequentially.
+        """
+        if other.order != self.order:
+            raise ValueError("cannot merge engines of different order")
 
-        return next_word
+        ids = self.__vocabulary.extend(other.__vocabulary)
 
-    def get_next_random(self):
-        return random.choice(self.__all_words)
+        for ngrams, other_ngrams in zip(self.__ngrams, other.__ngrams):
+            ngrams.merge(other_ngrams, ids)
+
+        self.__open_words.extend(map(ids.__getitem__, other.__open_words))
+        self.__all_words.extend(map(ids.__getitem__, other.__all_words))
+
+    def compact(self):
+        for ngrams in self.__ngrams:
+            ngrams.compact()
+
+    def add_source(self, file_path, fingerprint):
+        self.__sources[os.path.abspath(file_path)] = tuple(fingerprint)
+
+    def get_sources(self):
+        return dict(self.__sources)
+
+    def word_count(self):
+        return len(self.__open_words) + len(self.__all_words)
+
+    def thaw(self):
+        """Make an engine opened by load_from_dump learnable again."""
+        if isinstance(self.__vocabulary, MappedVocabulary):
+            vocabulary = Vocabulary()
+            for word in self.__vocabulary:
+                vocabulary.add(word)
+            self.__vocabulary = vocabulary
+
+        for ngrams in self.__ngrams:
+            ngrams.thaw()
+        self.__open_words = _copy_array(self.__open_words, 'i')
+        self.__all_words = _copy_array(self.__all_words, 'i')
 
     def dump(self):
-        file_dump = open(StatisticsEngine.dump_file_path, "wb")
-        pickle.dump(self, file_dump)
+        self.finalize()
+
+        sections = self.__vocabulary.sections()
+        for ngrams in self.__ngrams:
+            sections += ngrams.sections('{0}grams.'.format(ngrams.order))
+        sections += [('order', array('i', [self.order])),
+                     ('open_words', self.__open_words),
+                     ('all_words', self.__all_words),
+                     ('sources', array('B', json.dumps(
+                         sorted(self.__sources.iteritems()))))]
+
+        ModelFile.write(StatisticsEngine.dump_file_path, sections)
 
     @classmethod
     def load_from_dump(cls):
-        engine_dump = open(StatisticsEngine.dump_file_path, "rb")
-        return pickle.load(engine_dump)
+        """Open the dumped model lazily; nothing is decoded up front."""
+        model = ModelFile(StatisticsEngine.dump_file_path)
 
+        engine = cls(model.array('order')[0])
+        engine.__vocabulary = MappedVocabulary(model)
+        engine.__end_id = engine.__vocabulary.get_id(cls.END_OF_SENTENCE)
+        engine.__ngrams = [NgramStatistics.from_model(model, '{0}grams.'.format(n), n)
+                           for n in range(2, engine.order + 1)]
+        engine.__open_words = model.array('open_words')
+        engine.__all_words = model.array('all_words')
+        if 'sources' in model:
+            sources = model.array('sources')
+            engine.__sources = dict((str(path), tuple(fingerprint)) for path, fingerprint
+                                    in json.loads(sources.raw(0, len(sources))))
 
-def timeit(message_before, message_after):
-    def timeit_wrap(func):
-        @functools.wraps(func)
-        def newfunc(*args, **kwargs):
-            print(message_before)
-            start_time = time.time()
-            func(*args, **kwargs)
-            elapsed_time = time.time() - start_time
-            print(message_after + ' in {} ms\n'.format(
-                int(elapsed_time * 1000)))
+        return engine
 
-        return newfunc
 
-    return timeit_wrap
+@instrument.stage('load', "Loading engine...", "Engine loaded")
+def load_engine():
+    return StatisticsEngine.load_from_dump()
 
 
 class TextGenerator:
-    @timeit("Loading engine...", "Engine loaded")
-    def __init__(self, sentence_count, passage_count):
-        self.__engine = StatisticsEngine.load_from_dump()
+    """Generates text from an engine with its own random number generator.
+
+    Generators hold no other state, so many of them can share one loaded
+    engine, and the same seed always produces the same text.
+    """
+    # guards against argmax successors running in a cycle
+    MAX_SENTENCE_LENGTH = 60
+
+    def __init__(self, sentence_count, passage_count, sampling=False,
+                 seed=None, engine=None):
+        self.__engine = engine or load_engine()
         self.__passage_count = passage_count
         self.__sentence_count = sentence_count
+        self.__sampling = sampling
+        self.__random = random.Random(seed)
+        self.__last_open_word = None
+
+    def __next_for(self, *args):
+        if self.__sampling:
+            return self.__engine.sample_next_for(args, self.__random)
+
+        return self.__engine.get_next_for(*args)
 
     def __generate_sentence(self):
-        sentence = [self.__engine.get_open_word()]
-        next_word = self.__engine.get_next_for(sentence[-1]) or \
-                    self.__engine.get_next_random()
+        sentence = [self.__engine.get_open_word(self.__random, self.__last_open_word)]
+        self.__last_open_word = sentence[0]
+        next_word = self.__next_for(sentence[-1]) or \
+                    self.__engine.get_next_random(self.__random)
         sentence.append(next_word)
 
-        min_sentence_length = random.randint(4, 7)
+        min_sentence_length = self.__random.randint(4, 7)
+        context_length = self.__engine.order - 1
 
-        while True:
-            next_word = self.__engine.get_next_for(sentence[-2], sentence[-1])
+        while len(sentence) < self.MAX_SENTENCE_LENGTH:
+            next_word = self.__next_for(*sentence[-context_length:])
             # if there is no next word
             if next_word is None:
                 # if sentence is too short, just add random word
                 if len(sentence) < min_sentence_length:
-                    next_word = self.__engine.get_next_random()
+                    next_word = self.__engine.get_next_random(self.__random)
                 else:
                     break
             sentence.append(next_word)
 
         return " ".join(sentence) + ". "
 
-    def generate_text(self):
-        text = []
+    def iter_sentences(self):
+        """Yield sentences one at a time, without end."""
+        while True:
+            yield self.__generate_sentence()
+
+    def iter_text(self):
+        """Yield the text piece by piece: sentences and passage breaks."""
+        sentences = self.iter_sentences()
         for passage in range(self.__passage_count):
             for sentence in range(self.__sentence_count):
-                text.append(self.__generate_sentence())
+                yield next(sentences)
             if passage != self.__passage_count - 1:
-                text.append("\n\n")
+                yield "\n\n"
+
+    def generate_text(self):
+        return "".join(self.iter_text())
+
+
+_batch_engine = None
+
+
+def _init_batch_worker():
+    global _batch_engine
+    _batch_engine = StatisticsEngine.load_from_dump()
+
+
+def _generate_batch_text(task):
+    sentence_count, passage_count, sampling, seed = task
+    generator = TextGenerator(sentence_count, passage_count, sampling, seed,
+                              _batch_engine)
+    return generator.generate_text()
+
 
-        return "".join(text)
+def generate_batch(text_count, sentence_count, passage_count, sampling=False,
+                   seed=None, jobs=1, engine=None, use_threads=False):
+    """Generate text_count independent texts from one model.
+
+    Every text gets its own seed drawn from seed, so a batch is reproducible.
+    Threads share the given (or loaded) engine; worker processes map the
+    model once each at start-up and share its pages.
+    """
+    seeds = random.Random(seed)
+    tasks = [(sentence_count, passage_count, sampling, seeds.getrandbits(64))
+             for index in range(text_count)]
+
+    if use_threads or jobs <= 1:
+        engine = engine or load_engine()
+        # build lazy lookup tables before threads race to do it
+        engine.finalize(alias=sampling)
+        generate_one = lambda task: TextGenerator(*(task + (engine,))).generate_text()
+        if jobs <= 1:
+            return map(generate_one, tasks)
+        pool = multiprocessing.pool.ThreadPool(jobs)
+    else:
+        generate_one = _generate_batch_text
+        pool = multiprocessing.Pool(jobs, _init_batch_worker)
+
+    try:
+        return pool.map(generate_one, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def analyze_file(engine, file_path, tokenizer='stream'):
+    with open(file_path) as fileobj:
+        if tokenizer == 'regex':
+            # per line, sentence regex first and word regex over each sentence
+            for sentence in sentences(fileobj):
+                for word in words(sentence):
+                    engine.add_word(word)
+
+                engine.end_sentence()
+            return
+
+        for batch in tokens(fileobj):
+            engine.add_tokens(batch)
+        # an unterminated last sentence must not run into the next file
+        engine.end_sentence()
+
+
+def file_fingerprint(file_path):
+    """(size, mtime, md5) of a file, to tell whether it changed."""
+    file_stat = os.stat(file_path)
+    digest = hashlib.md5()
+    with open(file_path, 'rb') as fileobj:
+        for block in iter(lambda: fileobj.read(1024 * 1024), ''):
+            digest.update(block)
+
+    return file_stat.st_size, file_stat.st_mtime, digest.hexdigest()
+
+
+def learn_shard(task):
+    """Pool worker: learn consecutive files into a fresh engine."""
+    order, tokenizer, file_paths = task
+    engine = StatisticsEngine(order)
+    for file_path in file_paths:
+        analyze_file(engine, file_path, tokenizer)
+    # sorted tries are cheaper to merge and to send
+    engine.compact()
+
+    return engine
 
 
 class Learner:
-    def __init__(self, paths):
-        self.engine = StatisticsEngine()
+    SHARDS_PER_JOB = 4
+
+    def __init__(self, paths, sampling=False, jobs=1, update=False,
+                 order=3, min_count=1, top_k=None, tokenizer='stream'):
+        self.__jobs = jobs
+        self.__order = order
+        self.__tokenizer = tokenizer
+
+        file_paths = self.collect_files(paths)
+        self.engine = None
+        if update:
+            self.engine, file_paths = self.__load_for_update(file_paths)
+        if self.engine is None:
+            self.engine = StatisticsEngine(order)
+
+        self.__analyze_files(file_paths)
+        for file_path in file_paths:
+            self.engine.add_source(file_path, file_fingerprint(file_path))
+        self.__finalize(sampling, min_count, top_k)
+        self.__report_memory()
+
+    def __load_for_update(self, file_paths):
+        """Load the dumped model and pick the files it has not seen yet.
+
+        Learned files that are not given again stay in the model. Counts
+        of a file cannot be taken back out of it, so if a learned file
+        changed or disappeared, the given files and the learned ones still
+        on disk are relearned from scratch.
+        """
+        if not os.path.exists(StatisticsEngine.dump_file_path):
+            return None, file_paths
+
+        try:
+            engine = StatisticsEngine.load_from_dump()
+        except ValueError as error:
+            # an older or foreign model format cannot be continued
+            print "{0}, relearning everything".format(error)
+            return None, file_paths
+
+        sources = engine.get_sources()
+        if not sources:
+            print "Model has no record of learned files, relearning everything"
+            return None, file_paths
+
+        current = set(os.path.abspath(file_path) for file_path in file_paths)
+        kept = [path for path in sorted(sources)
+                if path not in current and os.path.isfile(path)]
+        if engine.order != self.__order:
+            print "Model has order {0}, relearning everything".format(engine.order)
+            return None, kept + file_paths
+
+        stale = [path for path, source in sources.iteritems()
+                 if not os.path.isfile(path) or self.__has_changed(path, source)]
+        if stale:
+            print "{0} learned files changed or disappeared, relearning everything".format(
+                len(stale))
+            return None, kept + file_paths
+
+        new_paths = [file_path for file_path in file_paths
+                     if os.path.abspath(file_path) not in sources]
+        print "{0} new files to learn".format(len(new_paths))
+        engine.thaw()
+
+        return engine, new_paths
+
+    def __has_changed(self, file_path, source):
+        size, mtime, digest = source
+        file_stat = os.stat(file_path)
+        if file_stat.st_size != size:
+            return True
+        if file_stat.st_mtime == mtime:
+            return False
+
+        return file_fingerprint(file_path)[2] != digest
+
+    @instrument.stage('finalize', "Finalizing engine...", "Engine finalized")
+    def __finalize(self, sampling, min_count, top_k):
+        self.engine.finalize(sampling, min_count, top_k)
+
+    def __report_memory(self):
+        for order, ngram_count, context_count, size in self.engine.memory_report():
+            print "{0}-grams: {1} n-grams in {2} contexts, {3:.1f} MB".format(
+                order, ngram_count, context_count, size / 1024.0 / 1024)
+            instrument.count('{0}-grams'.format(order), ngram_count)
+            instrument.count('{0}-gram contexts'.format(order), context_count)
+        print
+        instrument.snapshot('finalized')
+
+    @instrument.stage('analyze', "Analyzing texts...", "Texts analyzed")
+    def __analyze_files(self, file_paths):
+        if not file_paths:
+            return
 
-        self.__analyze_files(paths)
+        word_count = self.engine.word_count()
+        try:
+            self.__learn_files(file_paths)
+        finally:
+            instrument.count('files', len(file_paths))
+            instrument.count('words', self.engine.word_count() - word_count)
+
+    def __learn_files(self, file_paths):
+        if self.__jobs <= 1:
+            for file_path in file_paths:
+                analyze_file(self.engine, file_path, self.__tokenizer)
+            return
 
-    @timeit("Analyzing texts...", "Texts analyzed")
-    def __analyze_files(self, paths):
+        # shards are merged in file order, so the model is the same as
+        # after a sequential pass
+        pool = multiprocessing.Pool(self.__jobs)
+        try:
+            shards = [(self.__order, self.__tokenizer, shard)
+                      for shard in self.__split_shards(file_paths)]
+            for shard in pool.imap(learn_shard, shards):
+                with instrument.stage('merge'):
+                    self.engine.merge(shard)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def collect_files(paths):
+        file_paths = []
         for path in paths:
             # if passed path is file
             if os.path.isfile(path):
-                self.__analyze_one(path)
+                file_paths.append(path)
             else:
                 # otherwise just walking whole directory tree
                 # and analyzing every file
                 for directory, dirs, files in os.walk(path):
                     for file_name in files:
-                        self.__analyze_one(os.path.join(directory, file_name))
+                        file_paths.append(os.path.join(directory, file_name))
 
-    def __analyze_one(self, file_path):
-        fileobj = open(file_path)
+        return file_paths
 
-        for sentence in sentences(fileobj):
-            for word in words(sentence):
-                self.engine.add_word(word)
+    def __split_shards(self, file_paths):
+        """Group consecutive files into shards of roughly equal size."""
+        sizes = [os.path.getsize(file_path) for file_path in file_paths]
+        shard_size = float(sum(sizes)) / (self.__jobs * self.SHARDS_PER_JOB)
 
-            self.engine.end_sentence()
+        shards = [[]]
+        filled = 0
+        for file_path, size in zip(file_paths, sizes):
+            if shards[-1] and filled + size > shard_size:
+                shards.append([])
+                filled = 0
+            shards[-1].append(file_path)
+            filled += size
 
-    @timeit("Dumping engine...", "Engine dumped")
+        return [shard for shard in shards if shard]
+
+    @instrument.stage('dump', "Dumping engine...", "Engine dumped")
     def dump(self):
         self.engine.dump()
 
 
-def learn(paths):
-    learner = Learner(paths)
+def learn(paths, sampling=False, jobs=1, update=False, order=3, min_count=1,
+          top_k=None, tokenizer='stream'):
+    learner = Learner(paths, sampling, jobs, update, order, min_count, top_k,
+                      tokenizer)
     learner.dump()
 
 
-def generate(sentence_count, passage_count):
-    generator = TextGenerator(sentence_count, passage_count)
+def count_words(file_path, tokenizer='stream'):
+    """Tokenize a file without learning it, for benchmarking."""
+    with open(file_path) as fileobj:
+        if tokenizer == 'regex':
+            return sum(1 for sentence in sentences(fileobj) for word in words(sentence))
+
+        return sum(len(batch) - batch.count(None) for batch in tokens(fileobj))
+
+
+def benchmark(paths, order=3):
+    """Compare the tokenizers on the same files, alone and with learning."""
+    file_paths = Learner.collect_files(paths)
+    size = sum(os.path.getsize(file_path) for file_path in file_paths) / 1024.0 / 1024
+    print "{0} files, {1:.1f} MB".format(len(file_paths), size)
+
+    for tokenizer in ('regex', 'stream'):
+        start_time = time.time()
+        word_count = sum(count_words(file_path, tokenizer) for file_path in file_paths)
+        tokenize_time = time.time() - start_time
+
+        engine = StatisticsEngine(order)
+        start_time = time.time()
+        for file_path in file_paths:
+            analyze_file(engine, file_path, tokenizer)
+        engine.compact()
+        learn_time = time.time() - start_time
+
+        print "{0:>6}: {1} words, tokenized in {2} ms ({3:.1f} MB/s), " \
+              "learned in {4} ms ({5:.0f} words/s)".format(
+                  tokenizer, word_count, int(tokenize_time * 1000),
+                  size / tokenize_time, int(learn_time * 1000),
+                  word_count / learn_time)
+
+
+def generate(sentence_count, passage_count, sampling=False, seed=None,
+             text_count=1, jobs=1):
+    engine = load_engine()
+    if sampling and not engine.can_sample():
+        print "Model was learned without --sampling, relearn it with --sampling"
+        exit(-1)
+
+    if text_count > 1:
+        texts = generate_batch(text_count, sentence_count, passage_count,
+                               sampling, seed, jobs, engine)
+        for index, text in enumerate(texts):
+            print "Generated text #{0}: ".format(index + 1)
+            print text
+        return
+
+    generator = TextGenerator(sentence_count, passage_count, sampling, seed, engine)
     print "Generated text: "
-    print generator.generate_text()
+    with instrument.stage('generate'):
+        for piece in generator.iter_text():
+            sys.stdout.write(piece)
+    print
 
 
 if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option('-m', '--mode', type='choice',
                       action='store', dest='mode',
-                      choices=['learn', 'generate'],
-                      help='action to do: \'generate\' or \'learn\'')
+                      choices=['learn', 'generate', 'benchmark'],
+                      help='action to do: \'generate\', \'learn\' or '
+                           '\'benchmark\' (compare tokenizers on files)')
     parser.add_option('-p', '--passages', type='int', metavar='N',
                       dest='passage_count', help='passages count',
                       default=1)
     parser.add_option('-s', '--sentences', type='int', metavar='N',
                       dest='sentence_count', help='sentence count per passage',
                       default=10)
+    parser.add_option('--sampling', action='store_true', dest='sampling',
+                      help='learn: also store alias tables for sampling; '
+                           'generate: sample successors by frequency '
+                           'instead of taking the most frequent one',
+                      default=False)
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      dest='jobs', help='number of worker processes',
+                      default=1)
+    parser.add_option('-o', '--order', type='int', metavar='N',
+                      dest='order', help='learn: n-gram order',
+                      default=3)
+    parser.add_option('--min-count', type='int', metavar='N',
+                      dest='min_count', default=1,
+                      help='learn: drop n-grams seen fewer than N times')
+    parser.add_option('--top-k', type='int', metavar='K',
+                      dest='top_k',
+                      help='learn: keep only K most frequent successors '
+                           'of every context')
+    parser.add_option('--tokenizer', type='choice', dest='tokenizer',
+                      choices=['stream', 'regex'], default='stream',
+                      help='learn: \'stream\' scans text once in large '
+                           'chunks, \'regex\' splits every line into '
+                           'sentences and then words')
+    parser.add_option('-n', '--texts', type='int', metavar='N',
+                      dest='text_count', help='generate: number of texts',
+                      default=1)
+    parser.add_option('--seed', type='int', metavar='N',
+                      dest='seed', help='generate: random seed')
+    parser.add_option('-u', '--update', action='store_true', dest='update',
+                      help='learn: add only new files to the existing model',
+                      default=False)
+
+    instrument.add_options(parser)
 
     if len(sys.argv) < 2:
         parser.print_help()
         exit(-1)
 
     (options, args) = parser.parse_args()
+    instrument.configure(options)
 
     if options.mode == 'generate':
-        generate(options.sentence_count, options.passage_count)
+        generate(options.sentence_count, options.passage_count,
+                 options.sampling, options.seed, options.text_count,
+                 options.jobs)
     elif options.mode == 'learn':
         if len(args) == 0:
             print "no files provided!"
             exit(-1)
-        learn(args)
+        learn(args, options.sampling, options.jobs, options.update,
+              options.order, options.min_count, options.top_k,
+              options.tokenizer)
+    elif options.mode == 'benchmark':
+        if len(args) == 0:
+            print "no files provided!"
+            exit(-1)
+        benchmark(args, options.order)
+
+    instrument.finish()
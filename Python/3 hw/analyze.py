@@ -2,251 +2,392 @@ import csv
 import re
 import sys
 import math
-import time
-import functools
+import heapq
+import zlib
+import json
 import ntpath
+import os
+import multiprocessing
 
-from collections import defaultdict
+from array import array
+from optparse import OptionParser
 from string import lower
 
-class NeedMore(Exception):
-    pass
+import numpy as np
+from scipy import sparse
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import instrument
 
-def timeit(message_before='', message_after=''):
-    def timeit_wrap(func):
-        @functools.wraps(func)
-        def newfunc(*args, **kwargs):
-            if message_before != '':
-                print(message_before)
-            start_time = time.time()
-            ret_val = func(*args, **kwargs)
-            elapsed_time = time.time() - start_time
-            print(message_after + ' in {} ms\n'.format(
-                int(elapsed_time * 1000)))
-            return ret_val
 
-        return newfunc
-
-    return timeit_wrap
-
-
-class FreqCounter:
-
-    __slots__ = 'total_count tag_counts'.split()
-
-    def __init__(self):
-        self.total_count = 0
-        self.tag_counts = defaultdict(int)
-
-    def count(self, tag_list = list()):
-        self.total_count += 1
+class CountMinSketch(object):
+    """Approximate word counts in depth rows of width counters.
 
+    A word increments one counter per row, chosen by double hashing, and
+    its estimate is the smallest of them: never below the true count, and
+    above it by at most e * N / width with probability 1 - e ** -depth,
+    where N is the number of counted words.
+    """
+    WIDTH = 1 << 22
+    DEPTH = 4
+
+    def __init__(self, width=WIDTH, depth=DEPTH):
+        self.width = width
+        self.rows = [array('I', [0]) * width for row in range(depth)]
+
+    def add(self, word):
+        """Count word once, return its estimated count."""
+        first = hash(word)
+        second = zlib.crc32(word) | 1
+        estimate = None
+        for index, row in enumerate(self.rows):
+            column = (first + index * second) % self.width
+            row[column] += 1
+            if estimate is None or row[column] < estimate:
+                estimate = row[column]
+
+        return estimate
+
+
+class WordTagCounts(object):
+    """Per-word total and per-tag counts.
+
+    Words and tags are interned to consecutive ids. total_counts[word id]
+    is a numpy array, tag_counts a sparse word x tag matrix in CSR form,
+    so thousands of tags cost only the pairs actually seen. With tag_list
+    the tag columns are fixed, without it every tag seen gets a column.
+    Counted ids are buffered in flat arrays and added in bulk.
+
+    With by_combination, a column stands for the whole set of tags of a
+    post instead (see TagIndex); tag_list then only limits which tags are
+    known.
+
+    With sketch_threshold, words are first counted in a CountMinSketch and
+    get an entry only once their estimate reaches the threshold, so the
+    many words that never do cost no memory. The occurrences before that
+    are not counted, which is why the threshold is best kept at or below
+    the min count used for ranking.
+    """
+    FLUSH_SIZE = 1 << 20
+
+    def __init__(self, tag_list=None, sketch_threshold=0, by_combination=False):
+        self.sketch_threshold = sketch_threshold
+        self.sketch = CountMinSketch() if sketch_threshold > 1 else None
+        self.by_combination = by_combination
+        self.known_tags = tuple(tag_list) if tag_list is not None else None
+        self.fixed_tags = tag_list is not None and not by_combination
+        self.tag_list = list(tag_list or ()) if self.fixed_tags else list()
+        self.tag_columns = {tag: column for column, tag in enumerate(self.tag_list)}
+        self.word_ids = dict()
+        self.words = list()
+        self.word_count = 0
+        self.total_counts = np.zeros(0, dtype=np.int64)
+        self.tag_counts = sparse.csr_matrix((0, len(self.tag_list)), dtype=np.int64)
+
+        self.__pending = array('i')
+        self.__pending_rows = array('i')
+        self.__pending_columns = array('i')
+
+    @classmethod
+    def from_arrays(cls, words, total_counts, tag_counts, tag_list):
+        """Fixed-tag counts over ready arrays, e.g. loaded from a TagIndex."""
+        counts = cls(tag_list)
+        counts.words = list(words)
+        counts.word_ids = {word: word_id for word_id, word in enumerate(counts.words)}
+        counts.total_counts = total_counts
+        counts.tag_counts = tag_counts
+        counts.word_count = int(total_counts.sum())
+        return counts
+
+    def count(self, words, tag_list):
+        """Count every occurrence of words with every tag of tag_list."""
+        if self.by_combination:
+            tag_list = [TagIndex.combination(tag_list)]
+        word_ids = self.word_ids
+        ids = array('i')
+        for word in words:
+            word_id = word_ids.get(word)
+            if word_id is None:
+                if self.sketch and self.sketch.add(word) < self.sketch_threshold:
+                    continue
+                word_id = word_ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(word_id)
+
+        self.word_count += len(ids)
+        self.__pending.extend(ids)
         for tag in tag_list:
-            self.tag_counts[tag] += 1
-
+            self.__pending_rows.extend(ids)
+            self.__pending_columns.extend(array('i', [self.add_tag(tag)]) * len(ids))
+
+        if len(self.__pending_rows) >= self.FLUSH_SIZE:
+            self.flush()
+
+    def add_tag(self, tag):
+        column = self.tag_columns.get(tag)
+        if column is None:
+            if self.fixed_tags:
+                raise ValueError("unknown tag {0!r}".format(tag))
+            column = self.tag_columns[tag] = len(self.tag_list)
+            self.tag_list.append(tag)
+
+        return column
+
+    def flush(self):
+        """Add buffered ids to the counts."""
+        shape = (len(self.words), len(self.tag_list))
+        self.total_counts = self.__grow(self.total_counts, shape[0])
+        self.total_counts += np.bincount(self.__ids(self.__pending), minlength=shape[0])
+
+        pending = sparse.coo_matrix(
+            (np.ones(len(self.__pending_rows), dtype=np.int64),
+             (self.__ids(self.__pending_rows), self.__ids(self.__pending_columns))),
+            shape=shape)
+        self.__add_tag_counts(pending)
+
+        self.__pending = array('i')
+        self.__pending_rows = array('i')
+        self.__pending_columns = array('i')
+
+    def __add_tag_counts(self, tag_counts):
+        """Add a COO matrix, which may reach past the current shape."""
+        shape = tag_counts.shape
+        if self.tag_counts.shape != shape:
+            current = self.tag_counts.tocoo()
+            self.tag_counts = sparse.csr_matrix(
+                (current.data, (current.row, current.col)), shape=shape)
+        # converting to CSR sums duplicate entries
+        self.tag_counts = self.tag_counts + tag_counts.tocsr()
+
+    @staticmethod
+    def __grow(counts, size):
+        if len(counts) == size:
+            return counts
+
+        grown = np.zeros(size, dtype=counts.dtype)
+        grown[:len(counts)] = counts
+        return grown
+
+    @staticmethod
+    def __ids(ids):
+        return np.frombuffer(ids, dtype=np.int32)
+
+    def merge(self, other):
+        """Add the counts of another WordTagCounts."""
+        self.flush()
+        other.flush()
+        self.word_count += other.word_count
+
+        word_ids = self.word_ids
+        rows = np.empty(len(other.words), dtype=np.int64)
+        for other_id, word in enumerate(other.words):
+            word_id = word_ids.get(word)
+            if word_id is None:
+                word_id = word_ids[word] = len(self.words)
+                self.words.append(word)
+            rows[other_id] = word_id
+        columns = np.array([self.add_tag(tag) for tag in other.tag_list], dtype=np.int64)
+
+        self.total_counts = self.__grow(self.total_counts, len(self.words))
+        # rows are distinct, so fancy indexing adds every word once
+        self.total_counts[rows] += other.total_counts
+
+        other_counts = other.tag_counts.tocoo()
+        self.__add_tag_counts(sparse.coo_matrix(
+            (other_counts.data, (rows[other_counts.row], columns[other_counts.col])),
+            shape=(len(self.words), len(self.tag_list))))
+
+    def frequent_tag_counts(self, min_count):
+        """tag_counts with the rows of words counted fewer than min_count
+        times emptied, so word ids stay valid."""
+        self.flush()
+        frequent = (self.total_counts >= min_count).astype(np.int64)
+        tag_counts = sparse.diags(frequent).dot(self.tag_counts).tocsr()
+        tag_counts.eliminate_zeros()
+        return tag_counts
+
+    def sorted_ids(self):
+        """Word ids in the order of their words."""
+        return sorted(xrange(len(self.words)), key=self.words.__getitem__)
+
+    def __len__(self):
+        return len(self.words)
+
+
+class _Descending(object):
+    """Orders words backwards, so the heap root holds the largest word."""
+    __slots__ = ('word',)
+
+    def __init__(self, word):
+        self.word = word
+
+    def __lt__(self, other):
+        return self.word > other.word
+
+    def __eq__(self, other):
+        return self.word == other.word
 
-''' Trie implementation got from https://github.com/dhain/trie '''
 
-class Node(object):
-    """Internal representation of Trie nodes."""
-    __slots__ = 'parent key nodes value'.split()
-    no_value = object()
-
-    def __init__(self, parent, key, nodes, value):
-        self.parent = parent
-        self.key = key
-        self.nodes = nodes
-        self.value = value
+class TopChart:
+    """The TOP_COUNT best words by (pmi, pxy) descending, then by word.
 
-    @property
-    def keypath(self):
-        n = self
-        keypath = [n.key for n in iter(lambda: n.parent, None) if n.key]
-        keypath.reverse()
-        keypath.append(self.key)
-        return keypath
-
-    def walk(self):
-        nodes = [self]
-        while nodes:
-            node = nodes.pop()
-            if node.value is not node.no_value:
-                yield node
-            nodes.extend(node.nodes[key] for key in sorted(node.nodes, reverse=True))
-
-
-class Trie(object):
-    """A simple prefix tree (trie) implementation.
-    If attempting to access a node without a value, but with descendents,
-    NeedMore will be raised. If there are no descendents, KeyError will be
-    raised.
-    Usage:
-    >>> import trie
-    >>> from pprint import pprint
-    >>> t = trie.Trie()
-    >>> t['foobaz'] = 'Here is a foobaz.'
-    >>> t['foobar'] = 'This is a foobar.'
-    >>> t['fooqat'] = "What's a fooqat?"
-    >>> pprint(list(t))
-    [['f', 'o', 'o', 'b', 'a', 'r'],
-     ['f', 'o', 'o', 'b', 'a', 'z'],
-     ['f', 'o', 'o', 'q', 'a', 't']]
-    >>> pprint(list(t.iteritems()))
-    [(['f', 'o', 'o', 'b', 'a', 'r'], 'This is a foobar.'),
-     (['f', 'o', 'o', 'b', 'a', 'z'], 'Here is a foobaz.'),
-     (['f', 'o', 'o', 'q', 'a', 't'], "What's a fooqat?")]
-    >>> t['foo']
-    Traceback (most recent call last):
-        ...
-    NeedMore
-    >>> t['fooqux']
-    Traceback (most recent call last):
-        ...
-    KeyError: 'fooqux'
-    >>> t.children('fooba')
-    {'r': 'This is a foobar.', 'z': 'Here is a foobaz.'}
-    >>> del t['foobaz']
-    >>> pprint(list(t.iteritems()))
-    [(['f', 'o', 'o', 'b', 'a', 'r'], 'This is a foobar.'),
-     (['f', 'o', 'o', 'q', 'a', 't'], "What's a fooqat?")]
+    Entries live in a min-heap whose root is the worst kept entry, so a
+    word that does not get in costs one comparison and one that does
+    costs O(log TOP_COUNT). Ranking is a total order, so charts of
+    disjoint word sets merge into exactly the chart of their union.
     """
-
-    def __init__(self, root_data=Node.no_value, mapping=()):
-        """Initialize a Trie instance.
-        Args (both optional):
-            root_data:  value of the root node (ie. Trie('hello')[()] == 'hello').
-            mapping:    a sequence of (key, value) pairs to initialize with.
-        """
-        self.root = Node(None, None, {}, root_data)
-        self.extend(mapping)
-
-    def extend(self, mapping):
-        """Update the Trie with a sequence of (key, value) pairs."""
-        for k, v in mapping:
-            self[k] = v
-
-    def __setitem__(self, k, v):
-        n = self.root
-        for c in k:
-            n = n.nodes.setdefault(c, Node(n, c, {}, Node.no_value))
-        n.value = v
-
-    def _getnode(self, k):
-        n = self.root
-        for c in k:
-            try:
-                n = n.nodes[c]
-            except KeyError:
-                raise KeyError(k)
-        return n
-
-    def __getitem__(self, k):
-        n = None
-        try:
-            n = self._getnode(k)
-        except KeyError:
-            self[k] = FreqCounter()
-            n = self._getnode(k)
-        if n.value is Node.no_value:
-            n.value = FreqCounter()
-        return n.value
-
-    def __delitem__(self, k):
-        n = self._getnode(k)
-        if n.value is Node.no_value:
-            raise KeyError(k)
-        n.value = Node.no_value
-        while True:
-            if n.nodes or not n.parent or n.value is not Node.no_value:
-                break
-            del n.parent.nodes[n.key]
-            n = n.parent
-
-    def children(self, k):
-        """Return a dict of the immediate children of the given key.
-        Example:
-        >>> t = Trie()
-        >>> t['foobaz'] = 'Here is a foobaz.'
-        >>> t['foobar'] = 'This is a foobar.'
-        >>> t.children('fooba')
-        {'r': 'This is a foobar.', 'z': 'Here is a foobaz.'}
-        """
-        n = self._getnode(k)
-        return dict((k, n.nodes[k].value)
-                    for k in n.nodes
-                    if n.nodes[k].value is not Node.no_value)
-
-    def __iter__(self):
-        """Yield the keys in order."""
-        for node in self.root.walk():
-            yield node.keypath
-
-    def iteritems(self):
-        """Yield (key, value) pairs in order."""
-        for node in self.root.walk():
-            yield node.keypath, node.value
-
-    def itervalues(self):
-        """Yield values in order."""
-        for node in self.root.walk():
-            yield node.value
-
-class TopChart:
     TOP_COUNT = 10
-    cmpr = staticmethod(lambda a, b: a[1] < b[1] if a[2] == b[2] else a[2] < b[2])
 
-    def __init__(self):
-        self.top = list()
+    def __init__(self, top_count=None):
+        self.top_count = top_count or TopChart.TOP_COUNT
+        self.heap = list()
 
     def add_word(self, word, pxy, pmi, px):
-        if len(self.top) < TopChart.TOP_COUNT:
-            self.top.append((word, pxy, pmi, px))
-            self.__sort()
-            return
+        self.__add((pmi, pxy, _Descending(word), px))
 
-        if TopChart.cmpr(self.top[-1], (word, pxy, pmi, px)):
-            self.top.append((word, pxy, pmi, px))
-            self.__sort()
-            self.top.pop()
+    def merge(self, other):
+        for entry in other.heap:
+            self.__add(entry)
 
-    def __sort(self):
-        self.top.sort(key=lambda item: (item[2], item[1]), reverse=True)
+    def __add(self, entry):
+        if len(self.heap) < self.top_count:
+            heapq.heappush(self.heap, entry)
+        elif self.heap[0] < entry:
+            heapq.heapreplace(self.heap, entry)
+
+    @property
+    def top(self):
+        """(word, pxy, pmi, px) tuples, best first."""
+        return [(word.word, pxy, pmi, px)
+                for pmi, pxy, word, px in sorted(self.heap, reverse=True)]
 
 
 class CosineSimilCalculator:
-    def __init__(self):
-        self.lengths = defaultdict(int)
-        self.scalar_prods = defaultdict(int)
-
-    def process(self, freq_counter):
-        tag_counts = freq_counter.tag_counts
-        for tag1 in tag_counts:
-            for tag2 in tag_counts:
-                if tag1 == tag2:
-                    self.lengths[tag1] += tag_counts[tag1] ** 2
-                elif tag1 < tag2:
-                    prod_part = tag_counts[tag1] * tag_counts[tag2]
-                    self.scalar_prods[(tag1, tag2)] += prod_part
+    def __init__(self, tag_list):
+        self.tag_columns = {tag: column for column, tag in enumerate(tag_list)}
+        self.scalar_prods = sparse.csr_matrix((len(tag_list), len(tag_list)), dtype=np.int64)
+
+    def process(self, tag_counts):
+        """Add a sparse matrix of per-word tag count rows."""
+        self.scalar_prods = self.scalar_prods + tag_counts.T.dot(tag_counts).tocsr()
 
     def get_simil_coef(self, tag1, tag2):
-        key = (tag1, tag2) if tag1 < tag2 else (tag2, tag1)
-        length1 = math.sqrt(self.lengths[tag1])
-        length2 = math.sqrt(self.lengths[tag2])
+        column1 = self.tag_columns[tag1]
+        column2 = self.tag_columns[tag2]
+        length1 = math.sqrt(self.scalar_prods[column1, column1])
+        length2 = math.sqrt(self.scalar_prods[column2, column2])
 
         if length1 * length2 == 0:
             return 0
 
-        return float(self.scalar_prods[key]) / length1 / length2
+        return float(self.scalar_prods[column1, column2]) / length1 / length2
+
+
+class SparseTagStatistics:
+    """PMI ranking and tag similarities computed over whole matrices.
+
+    PMI is evaluated at once for every nonzero of the word x tag matrix,
+    kept in CSC form so the words of a tag are one contiguous slice.
+    Ranking sorts a tag's slice by (pmi, pxy) descending, ties broken by
+    word order, which is the order TopChart gives. Tag similarities come
+    from one sparse tag x tag product.
+    """
+    def __init__(self, counts, min_count=1):
+        self.words = counts.words
+        self.tag_columns = {tag: column for column, tag in enumerate(counts.tag_list)}
+
+        by_tag = counts.frequent_tag_counts(min_count).tocsc()
+        by_tag.sort_indices()
+        self.indptr = by_tag.indptr
+        self.rows = by_tag.indices
+        self.pxy = by_tag.data
+        self.pmi = np.log(self.pxy.astype(np.float64) / counts.total_counts[self.rows]) / math.log(2)
+
+        self.word_ranks = np.empty(len(self.words), dtype=np.int64)
+        self.word_ranks[counts.sorted_ids()] = np.arange(len(self.words))
+
+        self.scalar_prods = by_tag.T.dot(by_tag)
+
+    def top_words(self, tag, count):
+        column = self.tag_columns.get(tag)
+        if column is None:
+            return []
+
+        lo, hi = self.indptr[column], self.indptr[column + 1]
+        rows = self.rows[lo:hi]
+        order = np.lexsort((self.word_ranks[rows], -self.pxy[lo:hi], -self.pmi[lo:hi]))
+        return [self.words[row] for row in rows[order[:count]]]
+
+    def similarity_matrix(self):
+        """Cosine similarity of every pair of tag columns, as a dense array."""
+        products = self.scalar_prods.toarray().astype(np.float64)
+        lengths = np.sqrt(products.diagonal())
+        lengths[lengths == 0] = np.inf
+        return products / lengths[:, np.newaxis] / lengths[np.newaxis, :]
+
+class WindowedCounts(object):
+    """WordTagCounts per fixed time window of the post creation date.
+
+    Window keys are zero-padded ('2008', '2008-Q3', '2008-07'), so they
+    sort in time order and a range of windows is a range of keys.
+    """
+    WINDOWS = ('year', 'quarter', 'month')
+
+    def __init__(self, window, tag_list=None, by_combination=False):
+        if window not in WindowedCounts.WINDOWS:
+            raise ValueError("unknown window {0!r}".format(window))
+
+        self.window = window
+        self.known_tags = tuple(tag_list) if tag_list is not None else None
+        self.by_combination = by_combination
+        self.windows = dict()
+
+    @staticmethod
+    def window_key(window, date):
+        """Key of the window of a 'MM/DD/YYYY ...' or 'YYYY-MM-DD...' date."""
+        if '/' in date:
+            month, day, year = date.split(' ', 1)[0].split('/')
+        else:
+            year, month = date[0:4], date[5:7]
+
+        if window == 'year':
+            return year
+        if window == 'quarter':
+            return '{0}-Q{1}'.format(year, (int(month) - 1) // 3 + 1)
+        return '{0}-{1:02d}'.format(year, int(month))
+
+    def window_counts(self, date):
+        key = WindowedCounts.window_key(self.window, date)
+        counts = self.windows.get(key)
+        if counts is None:
+            counts = self.windows[key] = WordTagCounts(self.known_tags,
+                                                       by_combination=self.by_combination)
+        return counts
+
+    @property
+    def word_count(self):
+        return sum(counts.word_count for counts in self.windows.itervalues())
+
+    def flush(self):
+        for counts in self.windows.itervalues():
+            counts.flush()
+
+    def merge(self, other):
+        for key, counts in other.windows.iteritems():
+            if key in self.windows:
+                self.windows[key].merge(counts)
+            else:
+                self.windows[key] = counts
 
 TAG_LIST = ('c++', 'c', 'java', 'perl', 'python', 'ruby')
 
-def sort_out_tags(tag_list):
+def sort_out_tags(tag_list, known_tags=TAG_LIST):
     refined_tags = []
 
     for tag in tag_list:
-        if lower(tag) in TAG_LIST:
-            refined_tags.append(lower(tag))
+        tag = lower(tag)
+        if tag and (known_tags is None or tag in known_tags):
+            refined_tags.append(tag)
 
     return refined_tags
 
@@ -254,71 +395,472 @@ reg = re.compile('[A-Za-z]+')
 def get_words(text):
     return reg.findall(text)
 
-def build_trie(csv_file):
-    trie = Trie()
-    csv_reader = csv.reader(csv_file)
+def count_row(counts, row):
+    tag_list = sort_out_tags(row[8:13], counts.known_tags)
+    if len(tag_list) == 0:
+        return
+
+    if isinstance(counts, WindowedCounts):
+        counts = counts.window_counts(row[1])
+    counts.count(get_words(row[6]) + get_words(row[7]), tag_list)
+
+def new_counts(tag_list=TAG_LIST, sketch_threshold=0, by_combination=False, window=None):
+    if window is not None:
+        return WindowedCounts(window, tag_list, by_combination)
+
+    return WordTagCounts(tag_list, sketch_threshold, by_combination)
+
+@instrument.stage('count')
+def build_counts(file_path, jobs=1, *counts_args):
+    """Count a posts file into new_counts(*counts_args)."""
+    if jobs > 1:
+        counts = build_counts_parallel(file_path, jobs, *counts_args)
+    else:
+        counts = build_counts_serial(file_path, *counts_args)
+
+    instrument.count('words', counts.word_count)
+    instrument.snapshot('counted')
+    return counts
+
+def build_counts_serial(file_path, *counts_args):
+    counts = new_counts(*counts_args)
+    csv_reader = csv.reader(open(file_path, 'rb'))
     print("Analyzing...")
+    index = 0
     for index, row in enumerate(csv_reader):
         if index == 0:
             continue
 
-        tag_list = sort_out_tags(row[8:13])
-
-
         if index > 0 and index % 5000 == 0:
             print ("{} done...".format(index))
 
-        if len(tag_list) == 0:
-            continue
+        count_row(counts, row)
+    counts.flush()
+    instrument.count('rows', index)
+    return counts
 
-        words = get_words(row[6]) + get_words(row[7])
-        for word in words:
-            trie[word].count(tag_list)
-    return trie
+RANGES_PER_JOB = 4
+SCAN_BLOCK_SIZE = 1024 * 1024
+
+def split_records(file_path, count):
+    """Cut a CSV file into about count byte ranges of whole records.
 
-def process_trie(trie):
-    tops = {tag: TopChart() for tag in TAG_LIST}
-    cosine_calc = CosineSimilCalculator()
-    cos_proc = cosine_calc.process
+    Quoted fields may contain line breaks, so a line break ends a record
+    only after an even number of quotes since the start of the file
+    (escaped quotes come in pairs). Quotes are counted over the whole file
+    with str.count, which is far cheaper than parsing it.
+    """
+    file_size = os.path.getsize(file_path)
+    step = max(1, file_size // count)
+
+    boundaries = [0]
+    position = 0
+    quotes = 0
+    with open(file_path, 'rb') as csv_file:
+        for index in range(1, count):
+            target = index * step
+            while position < target:
+                block = csv_file.read(min(SCAN_BLOCK_SIZE, target - position))
+                if not block:
+                    break
+                quotes += block.count('"')
+                position += len(block)
+
+            boundary = None
+            while boundary is None:
+                block = csv_file.read(SCAN_BLOCK_SIZE)
+                if not block:
+                    boundary = file_size
+                    break
+
+                offset = 0
+                while True:
+                    newline = block.find('\n', offset)
+                    if newline == -1:
+                        quotes += block.count('"', offset)
+                        break
+
+                    quotes += block.count('"', offset, newline)
+                    offset = newline + 1
+                    if quotes % 2 == 0:
+                        boundary = position + offset
+                        break
+                position += len(block)
+
+            # continue counting from the boundary
+            position = boundary
+            csv_file.seek(position)
+
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    if file_size > boundaries[-1]:
+        boundaries.append(file_size)
+
+    return zip(boundaries[:-1], boundaries[1:])
+
+def read_lines(csv_file, end):
+    """Lines of csv_file up to the byte offset end."""
+    while csv_file.tell() < end:
+        line = csv_file.readline()
+        if not line:
+            break
+        yield line
+
+def count_range(task):
+    """Pool worker: count the records of one byte range."""
+    file_path, counts_args, (start, end) = task
+    counts = new_counts(*counts_args)
+    row_count = 0
+    with open(file_path, 'rb') as csv_file:
+        csv_file.seek(start)
+        csv_reader = csv.reader(read_lines(csv_file, end))
+        if start == 0:
+            next(csv_reader, None)
+
+        for row in csv_reader:
+            count_row(counts, row)
+            row_count += 1
+    counts.flush()
+    # the sketch is only needed while counting, and is large to send back
+    counts.sketch = None
+    return row_count, counts
+
+def build_counts_parallel(file_path, jobs, *counts_args):
+    counts = new_counts(*counts_args)
+    tasks = [(file_path, counts_args, byte_range)
+             for byte_range in split_records(file_path, jobs * RANGES_PER_JOB)]
+    print("Analyzing...")
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        done = 0
+        for row_count, partial in pool.imap(count_range, tasks):
+            counts.merge(partial)
+            done += row_count
+            print ("{} done...".format(done))
+    finally:
+        pool.close()
+        pool.join()
+    instrument.count('rows', done)
+    return counts
+
+def rank_counts(counts, tags, top_count, min_count):
+    """Reference ranking: PMI word by word, kept in a TopChart per tag."""
+    tag_counts = counts.frequent_tag_counts(min_count)
+    tops = {tag: TopChart(top_count) for tag in tags}
+    cosine_calc = CosineSimilCalculator(counts.tag_list)
+    cosine_calc.process(tag_counts)
     log = math.log
-    for word, freq_counter in trie.iteritems():
-        word = ''.join(word)
-        px = freq_counter.total_count
-        cos_proc(freq_counter)
-        for tag in freq_counter.tag_counts:
-            pxy = freq_counter.tag_counts[tag]
-            if pxy == 0:
+    words = counts.words
+    total_counts = counts.total_counts.tolist()
+    indptr = tag_counts.indptr.tolist()
+    columns = tag_counts.indices.tolist()
+    data = tag_counts.data.tolist()
+    # words in sorted order, so equally ranked words keep their order
+    for word_id in counts.sorted_ids():
+        word = words[word_id]
+        px = total_counts[word_id]
+        for index in xrange(indptr[word_id], indptr[word_id + 1]):
+            tag = counts.tag_list[columns[index]]
+            pxy = data[index]
+            if pxy == 0 or tag not in tops:
                 continue
 
             pmi = log(float(pxy) / px, 2)
             tops[tag].add_word(word, pxy, pmi, px)
 
-    for tag in TAG_LIST:
+    top_words = {tag: [x[0] for x in tops[tag].top] for tag in tags}
+    return top_words, cosine_calc.get_simil_coef
+
+def rank_sparse(counts, tags, top_count, min_count):
+    statistics = SparseTagStatistics(counts, min_count)
+    top_words = {tag: statistics.top_words(tag, top_count) for tag in tags}
+    similarities = statistics.similarity_matrix()
+    columns = {tag: column for column, tag in enumerate(counts.tag_list)}
+
+    def get_simil_coef(tag1, tag2):
+        return similarities[columns[tag1], columns[tag2]]
+
+    return top_words, get_simil_coef
+
+class TagIndex(object):
+    """Word counts saved to a directory, for queries without the CSV.
+
+    Which posts a query counts depends on its tags: a post without any of
+    them is skipped. So the index counts words per combination of post
+    tags, and a query derives its own table exactly, with two sparse
+    products: tag counts through a combination x tag incidence matrix
+    (a tag given twice counts twice), word totals through the indicator
+    of combinations sharing a tag with the query.
+
+    Files: index.json (tags, combinations), words.txt (sorted words, one
+    per line), totals.npy and counts.{data,indices,indptr}.npy, the CSR
+    word x combination matrix, opened memory-mapped.
+    """
+    VERSION = 1
+    SEPARATOR = ' '
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as info_file:
+            info = json.load(info_file)
+        if info['version'] != TagIndex.VERSION:
+            raise ValueError("unsupported index version {0}".format(info['version']))
+
+        self.tag_list = info['tags']
+        self.combinations = [str(combination) for combination in info['combinations']]
+        with open(os.path.join(path, 'words.txt'), 'rb') as words_file:
+            self.words = words_file.read().split('\n')[:-1]
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        self.totals = load('totals')
+        self.counts = sparse.csr_matrix(
+            (load('counts.data'), load('counts.indices'), load('counts.indptr')),
+            shape=(len(self.words), len(self.combinations)))
+
+    @staticmethod
+    def combination(tag_list):
+        return TagIndex.SEPARATOR.join(sorted(tag_list))
+
+    @staticmethod
+    def save(path, counts):
+        """Save WordTagCounts counted by_combination."""
+        counts.flush()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        order = counts.sorted_ids()
+        tag_counts = counts.tag_counts[order]
+        with open(os.path.join(path, 'words.txt'), 'wb') as words_file:
+            for word_id in order:
+                words_file.write(counts.words[word_id] + '\n')
+        np.save(os.path.join(path, 'totals.npy'), counts.total_counts[order])
+        np.save(os.path.join(path, 'counts.data.npy'), tag_counts.data)
+        np.save(os.path.join(path, 'counts.indices.npy'), tag_counts.indices)
+        np.save(os.path.join(path, 'counts.indptr.npy'), tag_counts.indptr)
+
+        # written last: an index without it is incomplete
+        info = {
+            'version': TagIndex.VERSION,
+            'tags': list(counts.known_tags) if counts.known_tags is not None else None,
+            'combinations': counts.tag_list,
+        }
+        with open(os.path.join(path, 'index.json'), 'w') as info_file:
+            json.dump(info, info_file)
+
+    def all_tags(self):
+        if self.tag_list is not None:
+            return list(self.tag_list)
+
+        return sorted(set(tag for combination in self.combinations
+                          for tag in combination.split(TagIndex.SEPARATOR)))
+
+    def counts_for(self, tag_list):
+        """WordTagCounts of the posts with a tag of tag_list."""
+        if self.tag_list is not None:
+            unknown = [tag for tag in tag_list if tag not in self.tag_list]
+            if unknown:
+                raise ValueError("tags not in the index: {0}".format(', '.join(unknown)))
+
+        columns = {tag: column for column, tag in enumerate(tag_list)}
+        rows = array('i')
+        tag_columns = array('i')
+        for row, combination in enumerate(self.combinations):
+            for tag in combination.split(TagIndex.SEPARATOR):
+                if tag in columns:
+                    rows.append(row)
+                    tag_columns.append(columns[tag])
+        incidence = sparse.coo_matrix(
+            (np.ones(len(rows), dtype=np.int64),
+             (np.frombuffer(rows, dtype=np.int32), np.frombuffer(tag_columns, dtype=np.int32))),
+            shape=(len(self.combinations), len(tag_list))).tocsr()
+        shares_tag = (incidence.getnnz(axis=1) > 0).astype(np.int64)
+
+        return WordTagCounts.from_arrays(
+            self.words, self.counts.dot(shares_tag), self.counts.dot(incidence).tocsr(),
+            tag_list)
+
+class WindowedIndex(object):
+    """A TagIndex per time window, saved in subdirectories named by key."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'windows.json')) as info_file:
+            info = json.load(info_file)
+
+        self.path = path
+        self.window = info['window']
+        self.keys = [str(key) for key in info['windows']]
+
+    @staticmethod
+    def is_windowed(path):
+        return os.path.exists(os.path.join(path, 'windows.json'))
+
+    @staticmethod
+    def save(path, counts):
+        """Save WindowedCounts counted by_combination."""
+        keys = sorted(counts.windows)
+        for key in keys:
+            TagIndex.save(os.path.join(path, key), counts.windows[key])
+
+        with open(os.path.join(path, 'windows.json'), 'w') as info_file:
+            json.dump({'window': counts.window, 'windows': keys}, info_file)
+
+    def keys_between(self, first=None, last=None):
+        """Keys of the windows from first to last, both included."""
+        return [key for key in self.keys
+                if (first is None or key >= first) and (last is None or key <= last)]
+
+    def all_tags(self, keys):
+        tags = set()
+        for key in keys:
+            tags.update(TagIndex(os.path.join(self.path, key)).all_tags())
+        return sorted(tags)
+
+    def counts_for(self, tag_list, keys):
+        """WordTagCounts of the posts of the given windows, merged."""
+        counts = WordTagCounts(tag_list)
+        for key in keys:
+            counts.merge(TagIndex(os.path.join(self.path, key)).counts_for(tag_list))
+        return counts
+
+ENGINES = {
+    'python': rank_counts,
+    'sparse': rank_sparse,
+}
+
+MIN_COUNT = 5
+
+@instrument.stage('rank')
+def process_counts(counts, tags=None, engine='sparse', top_count=TopChart.TOP_COUNT,
+                   min_count=MIN_COUNT):
+    """Print top words of every tag and tag similarities, counting only
+    words seen at least min_count times."""
+    if tags is None:
+        tags = counts.tag_list if counts.fixed_tags else sorted(counts.tag_list)
+    top_words, get_simil_coef = ENGINES[engine](counts, tags, top_count, min_count)
+    instrument.count('distinct words', len(counts))
+    instrument.count('tags', len(tags))
+
+    for tag in tags:
         print("Top for {}:".format(tag))
-        print('\n'.join([x[0] for x in tops[tag].top]))
+        print('\n'.join(top_words[tag]))
         print('-'*40)
 
-    for tag1 in TAG_LIST:
-        for tag2 in TAG_LIST:
+    for tag1 in tags:
+        for tag2 in tags:
             if tag1 < tag2:
-                print("{0} is similar to {1} for about {2:.4f}".format(tag1, tag2, cosine_calc.get_simil_coef(tag1, tag2)))
-
-def filter_trie(trie):
-    for word, freq_counter in trie.iteritems():
-        if freq_counter.total_count < 5:
-            del(trie[''.join(word)])
+                print("{0} is similar to {1} for about {2:.4f}".format(tag1, tag2, get_simil_coef(tag1, tag2)))
 
-@timeit(message_after='Work done')
 def main():
-    if len(sys.argv) < 2:
-        print("USAGE: {0} <filename>".format(ntpath.basename(sys.argv[0])))
+    parser = OptionParser(usage="{0} [options] <filename>".format(
+        ntpath.basename(sys.argv[0])))
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+                      dest='jobs', help='number of worker processes',
+                      default=1)
+    parser.add_option('-t', '--tags', metavar='TAG,TAG...',
+                      dest='tags',
+                      help='comma-separated tags to analyze (default: {0}; '
+                           'every tag with --build-index)'.format(','.join(TAG_LIST)))
+    parser.add_option('--all-tags', action='store_true', dest='all_tags',
+                      help='analyze every tag found in the file',
+                      default=False)
+    parser.add_option('-e', '--engine', type='choice', dest='engine',
+                      choices=sorted(ENGINES), default='sparse',
+                      help='\'sparse\' ranks whole sparse matrices at once, '
+                           '\'python\' ranks word by word')
+    parser.add_option('-k', '--top', type='int', metavar='K',
+                      dest='top_count', default=TopChart.TOP_COUNT,
+                      help='words to show per tag (default: %default)')
+    parser.add_option('-c', '--min-count', type='int', metavar='N',
+                      dest='min_count', default=MIN_COUNT,
+                      help='rank only words seen at least N times '
+                           '(default: %default)')
+    parser.add_option('--sketch-threshold', type='int', metavar='N',
+                      dest='sketch_threshold', default=0,
+                      help='keep a word only after a count-min sketch has '
+                           'seen it N times; its first occurrences are '
+                           'not counted')
+    parser.add_option('--build-index', metavar='DIR', dest='build_index',
+                      help='count the file by tag combination into an '
+                           'index in DIR, for later --index queries; every '
+                           'tag is indexed unless --tags is given')
+    parser.add_option('--index', metavar='DIR', dest='index',
+                      help='query an index built by --build-index '
+                           'instead of reading a file')
+    parser.add_option('-w', '--window', type='choice', dest='window',
+                      choices=WindowedCounts.WINDOWS,
+                      help='with --build-index: keep separate counts per '
+                           '\'year\', \'quarter\' or \'month\' of the '
+                           'post creation date')
+    parser.add_option('--from', metavar='KEY', dest='first_window',
+                      help='with --index: first window to merge, e.g. 2008-07')
+    parser.add_option('--to', metavar='KEY', dest='last_window',
+                      help='with --index: last window to merge, included')
+    instrument.add_options(parser)
+    (options, args) = parser.parse_args()
+    if len(args) < 1 and options.index is None:
+        parser.print_usage()
         exit(0)
-
-    csv_file = open(sys.argv[1], 'rb')
-    trie = build_trie(csv_file)
-    filter_trie(trie)
-    process_trie(trie)
+    if options.window is not None and options.build_index is None:
+        parser.error("--window works only with --build-index")
+    if options.window is not None and options.sketch_threshold:
+        parser.error("--sketch-threshold does not work with --window")
+
+    instrument.configure(options)
+    with instrument.stage('total', message_after='Work done'):
+        run(options, args)
+    instrument.finish()
+
+def run(options, args):
+    if options.all_tags:
+        tag_list = None
+    elif options.tags is not None:
+        tag_list = options.tags.split(',')
+    elif options.build_index is not None:
+        # an index is queried later with any tags, so it counts all of them
+        tag_list = None
+    else:
+        tag_list = list(TAG_LIST)
+    if options.build_index is not None:
+        counts = build_counts(args[0], options.jobs, tag_list, options.sketch_threshold,
+                              True, options.window)
+        with instrument.stage('save'):
+            if options.window is not None:
+                WindowedIndex.save(options.build_index, counts)
+                print("Index of {0} windows saved to {1}".format(
+                    len(counts.windows), options.build_index))
+            else:
+                TagIndex.save(options.build_index, counts)
+                print("Index of {0} words saved to {1}".format(len(counts), options.build_index))
+        return
+
+    try:
+        if options.index is None:
+            counts = build_counts(args[0], options.jobs, tag_list, options.sketch_threshold)
+        else:
+            counts = load_counts(options.index, tag_list, options.first_window,
+                                 options.last_window)
+    except ValueError as error:
+        print(error)
+        exit(-1)
+    process_counts(counts, engine=options.engine, top_count=options.top_count,
+                   min_count=options.min_count)
+
+@instrument.stage('load')
+def load_counts(path, tag_list, first_window=None, last_window=None):
+    """Counts of tag_list (all tags if None) from an index."""
+    if WindowedIndex.is_windowed(path):
+        index = WindowedIndex(path)
+        keys = index.keys_between(first_window, last_window)
+        if not keys:
+            raise ValueError("no windows in the given range")
+        print("Windows {0} to {1}".format(keys[0], keys[-1]))
+        return index.counts_for(tag_list or index.all_tags(keys), keys)
+
+    index = TagIndex(path)
+    return index.counts_for(tag_list or index.all_tags())
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
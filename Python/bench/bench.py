@@ -0,0 +1,420 @@
+"""Throughput benchmarks for the homework scripts.
+
+Generates synthetic inputs of a chosen size, runs every script on them in
+a child process and records wall time, rows/s or words/s, peak RSS and
+model load time. Results can be saved as a baseline and later runs
+compared against it, flagging regressions beyond a tolerance. --check
+instead checks that parallel runs print the same as serial ones.
+
+Usage:
+    python bench.py --size small --save-baseline baseline.json
+    python bench.py --size small --baseline baseline.json
+    python bench.py --size small --check
+"""
+import os
+import re
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TASK1 = os.path.join(ROOT, '1 hw', 'task1.py')
+TASK2 = os.path.join(ROOT, '1 hw', 'task2.py')
+TEXT_GENERATOR = os.path.join(ROOT, '2 hw', 'text_generator.py')
+ANALYZE = os.path.join(ROOT, '3 hw', 'analyze.py')
+
+# rows of the integer CSV, words of the text corpus, posts of the posts CSV
+SIZES = {
+    'small': (200000, 300000, 20000),
+    'medium': (2000000, 3000000, 200000),
+    'large': (10000000, 15000000, 1000000),
+}
+SEED = 1
+
+CORPUS_FILES = 8
+POSTS_HEADER = ['PostId', 'PostCreationDate', 'OwnerUserId', 'OwnerCreationDate',
+                'ReputationAtPostCreation', 'OwnerUndeletedAnswerCountAtPostCreation',
+                'Title', 'BodyMarkdown', 'Tag1', 'Tag2', 'Tag3', 'Tag4', 'Tag5',
+                'PostClosedDate', 'OpenStatus']
+POST_TAGS = ['c++', 'c', 'java', 'perl', 'python', 'ruby', 'php', 'javascript',
+             'sql', 'haskell', '', '', '', '', '']
+
+# metric -> True if higher is better
+METRICS = {
+    'seconds': False,
+    'rows_per_s': True,
+    'words_per_s': True,
+    'peak_rss_mb': False,
+    'load_ms': False,
+}
+LOAD_TIME_PATTERN = re.compile(r'Engine loaded in (\d+) ms')
+
+
+def make_vocabulary(rng, size):
+    """Random lowercase words, drawn later with a Zipf-like skew."""
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    words = set()
+    while len(words) < size:
+        length = rng.randint(2, 9)
+        words.add(''.join(rng.choice(letters[:rng.randint(6, 26)]) for _ in range(length)))
+
+    return sorted(words)
+
+
+def zipf_word(rng, vocabulary):
+    return vocabulary[int(len(vocabulary) * rng.random() ** 3)]
+
+
+def generate_integers(path, rows, rng):
+    """Integer CSV for task2: three columns, some values 'None'."""
+    with open(path, 'w') as out:
+        out.write('a,b,c\n')
+        for index in xrange(rows):
+            a = 'None' if rng.random() < 0.1 else str(rng.randint(-50, 50))
+            b = 'None' if rng.random() < 0.2 else str(rng.randint(0, 10 ** 6))
+            out.write('{0},{1},{2}\n'.format(a, b, rng.randint(1, 9)))
+
+    return {'rows': rows}
+
+
+def generate_mixed(path, rows, rng):
+    """CSV for task2 whose columns change type after the type sample.
+
+    a turns float half way and categorical on its last row, b turns
+    categorical at three quarters; numbers are spelled in several ways.
+    """
+    with open(path, 'w') as out:
+        out.write('a,b\n')
+        for index in xrange(rows):
+            if index == rows - 1:
+                a = 'xyz'
+            elif index == rows // 2:
+                a = '1.5'
+            else:
+                a = rng.choice(['1', '01', '1.0'] if index < rows // 2 else ['2', '2.00'])
+            b = 'n/a' if index == rows * 3 // 4 else str(rng.randint(0, 100))
+            out.write('{0},{1}\n'.format(a, b))
+
+    return {'rows': rows}
+
+
+def generate_corpus(directory, word_count, rng):
+    """Text for task1 and text_generator: sentences wrapped into lines."""
+    os.makedirs(directory)
+    vocabulary = make_vocabulary(rng, 20000)
+    per_file = word_count // CORPUS_FILES
+
+    for index in range(CORPUS_FILES):
+        with open(os.path.join(directory, 'part{0}.txt'.format(index)), 'w') as out:
+            line_length = 0
+            for position in xrange(per_file):
+                word = zipf_word(rng, vocabulary)
+                if position == 0 or rng.random() < 0.08:
+                    word = word.capitalize()
+                if rng.random() < 0.07:
+                    word += rng.choice('...!?;,')
+                out.write(word)
+                line_length += len(word) + 1
+                if line_length > 70:
+                    out.write('\n')
+                    line_length = 0
+                else:
+                    out.write(' ')
+            out.write('.\n')
+
+    return {'words': per_file * CORPUS_FILES}
+
+
+def generate_posts(path, posts, rng):
+    """Posts CSV for analyze.py, with quoted multiline bodies."""
+    vocabulary = make_vocabulary(rng, 30000)
+
+    def text(length):
+        parts = []
+        for _ in range(length):
+            parts.append(zipf_word(rng, vocabulary))
+            if rng.random() < 0.05:
+                parts.append('\n')
+        return ' '.join(parts)
+
+    word_count = 0
+    with open(path, 'wb') as out:
+        writer = csv.writer(out)
+        writer.writerow(POSTS_HEADER)
+        for index in xrange(posts):
+            title, body = text(rng.randint(3, 10)), text(rng.randint(10, 80))
+            word_count += len(title.split()) + len(body.split())
+            months = index * 48 // posts
+            date = '{0:02d}/{1:02d}/{2} 12:00:00'.format(
+                months % 12 + 1, index % 28 + 1, 2008 + months // 12)
+            writer.writerow([index, date, 1, date, 1, 0, title, body] +
+                            rng.sample(POST_TAGS, 5) + ['', 'open'])
+
+    return {'rows': posts, 'words': word_count}
+
+
+def prepare_data(data_dir, size):
+    """Generate the missing inputs of a size, return their metadata."""
+    directory = os.path.join(data_dir, size)
+    info_path = os.path.join(directory, 'info.json')
+    info = dict()
+    if os.path.exists(info_path):
+        with open(info_path) as info_file:
+            info = json.load(info_file)
+
+    rows, words, posts = SIZES[size]
+    inputs = [
+        ('integers', generate_integers, 'integers.csv', rows),
+        ('mixed', generate_mixed, 'mixed.csv', rows),
+        ('corpus', generate_corpus, 'corpus', words),
+        ('posts', generate_posts, 'posts.csv', posts),
+    ]
+    missing = [entry for entry in inputs if entry[0] not in info]
+    if not missing:
+        return info
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    print "Generating {0} inputs in {1}...".format(size, directory)
+    for name, generate, file_name, count in missing:
+        info[name] = generate(os.path.join(directory, file_name), count,
+                              random.Random(SEED))
+    with open(info_path, 'w') as info_file:
+        json.dump(info, info_file)
+
+    return info
+
+
+def run(command, cwd):
+    """Run a command, return (seconds, peak RSS in MB, output)."""
+    with tempfile.TemporaryFile() as output:
+        start_time = time.time()
+        process = subprocess.Popen(command, cwd=cwd, stdout=output, stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of this child alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        elapsed_time = time.time() - start_time
+        process.returncode = status
+        output.seek(0)
+        text = output.read()
+
+    if status != 0:
+        raise RuntimeError("{0} failed:\n{1}".format(' '.join(command), text))
+
+    return elapsed_time, usage.ru_maxrss / 1024.0, text
+
+
+def cases(data_dir, info, jobs):
+    """(name, command, unit, unit count, required case) of every benchmark.
+
+    Cases run in order in one working directory, so a case can use what
+    its required case wrote there.
+    """
+    integers = os.path.join(data_dir, 'integers.csv')
+    corpus = os.path.join(data_dir, 'corpus')
+    corpus_file = os.path.join(corpus, 'part0.txt')
+    posts = os.path.join(data_dir, 'posts.csv')
+    python = sys.executable
+    rows, words = info['integers']['rows'], info['corpus']['words']
+
+    return [
+        ('task1', [python, TASK1, corpus_file], 'words', words // CORPUS_FILES, None),
+        ('task1 --mmap', [python, TASK1, '--mmap', corpus_file], 'words',
+         words // CORPUS_FILES, None),
+        ('task2 exact', [python, TASK2, integers], 'rows', rows, None),
+        ('task2 streaming', [python, TASK2, '-m', 'streaming', integers], 'rows', rows, None),
+        ('task2 approx', [python, TASK2, '-m', 'approx', integers], 'rows', rows, None),
+        ('task2 numpy', [python, TASK2, '-e', 'numpy', integers], 'rows', rows, None),
+        ('task2 -j', [python, TASK2, '-j', str(jobs), integers], 'rows', rows, None),
+        ('learn', [python, TEXT_GENERATOR, '-m', 'learn', corpus], 'words', words, None),
+        ('learn -j', [python, TEXT_GENERATOR, '-m', 'learn', '-j', str(jobs), corpus],
+         'words', words, None),
+        ('generate', [python, TEXT_GENERATOR, '-m', 'generate', '-s', '50', '--seed', '1'],
+         None, None, 'learn'),
+        ('learn --sampling', [python, TEXT_GENERATOR, '-m', 'learn', '--sampling', corpus],
+         'words', words, None),
+        ('generate --sampling', [python, TEXT_GENERATOR, '-m', 'generate', '-s', '50',
+                                 '--seed', '1', '--sampling'], None, None, 'learn --sampling'),
+        ('analyze', [python, ANALYZE, posts], 'rows', info['posts']['rows'], None),
+        ('analyze -j', [python, ANALYZE, '-j', str(jobs), posts], 'rows', info['posts']['rows'],
+         None),
+        ('analyze --build-index', [python, ANALYZE, '--build-index', 'posts.index',
+                                   '--all-tags', posts], 'rows', info['posts']['rows'], None),
+        ('analyze --index', [python, ANALYZE, '--index', 'posts.index'], None, None,
+         'analyze --build-index'),
+    ]
+
+
+def agreement_checks(data_dir, jobs):
+    """(name, serial command, parallel command) pairs that must print the same."""
+    python = sys.executable
+    jobs = str(jobs)
+    checks = []
+    for file_name in ('integers.csv', 'mixed.csv'):
+        path = os.path.join(data_dir, file_name)
+        for options in ([], ['-m', 'streaming'], ['--mmap']):
+            checks.append((' '.join(['task2'] + options + [file_name]),
+                           [python, TASK2] + options + [path],
+                           [python, TASK2, '-j', jobs] + options + [path]))
+
+    return checks
+
+
+def check(data_dir, jobs):
+    """Run every agreement check, return the names of those that failed."""
+    failed = []
+    work_dir = tempfile.mkdtemp(prefix='bench')
+    try:
+        for name, serial, parallel in agreement_checks(data_dir, jobs):
+            same = run(serial, work_dir)[2] == run(parallel, work_dir)[2]
+            if not same:
+                failed.append(name)
+            print "{0:<40} {1}".format(name, 'ok' if same else 'DIFFERENT OUTPUT')
+    finally:
+        shutil.rmtree(work_dir)
+
+    return failed
+
+
+def benchmark(data_dir, info, jobs, repeat, only=None):
+    all_cases = cases(data_dir, info, jobs)
+    selected = set(name for name, _, _, _, _ in all_cases
+                   if not only or any(pattern in name for pattern in only))
+    selected.update([required for name, _, _, _, required in all_cases
+                     if name in selected and required])
+
+    results = dict()
+    work_dir = tempfile.mkdtemp(prefix='bench')
+    try:
+        for name, command, unit, unit_count, required in all_cases:
+            if name not in selected:
+                continue
+
+            runs = [run(command, work_dir) for _ in range(repeat)]
+            seconds = min(elapsed_time for elapsed_time, _, _ in runs)
+            result = {
+                'seconds': seconds,
+                'peak_rss_mb': max(peak_rss for _, peak_rss, _ in runs),
+            }
+            if unit is not None:
+                result[unit + '_per_s'] = unit_count / seconds
+            load_times = [int(match) for _, _, text in runs
+                          for match in LOAD_TIME_PATTERN.findall(text)]
+            if load_times:
+                result['load_ms'] = min(load_times)
+
+            results[name] = result
+            print format_result(name, result)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return results
+
+
+def format_result(name, result):
+    parts = ['{0:<24}'.format(name), '{0:8.2f} s'.format(result['seconds'])]
+    for metric, caption in (('rows_per_s', 'rows/s'), ('words_per_s', 'words/s')):
+        if metric in result:
+            parts.append('{0:12.0f} {1}'.format(result[metric], caption))
+    parts.append('{0:8.1f} MB'.format(result['peak_rss_mb']))
+    if 'load_ms' in result:
+        parts.append('load {0} ms'.format(result['load_ms']))
+
+    return '  '.join(parts)
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against the baseline, return the regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            if metric not in results[name] or metric not in baseline[name]:
+                continue
+
+            old, new = baseline[name][metric], results[name][metric]
+            if old == 0:
+                continue
+            change = float(new - old) / old
+            worse = -change if higher_is_better else change
+            if worse > tolerance:
+                regressions.append((name, metric, old, new))
+                mark = 'REGRESSION'
+            elif -worse > tolerance:
+                mark = 'improved'
+            else:
+                continue
+            print "{0:<24} {1:<12} {2:>12.2f} -> {3:>12.2f} ({4:+.0%}) {5}".format(
+                name, metric, old, new, change, mark)
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--size', type='choice', dest='size',
+                      choices=sorted(SIZES), default='small',
+                      help='input size: {0} (default: %default)'.format(
+                          ', '.join(sorted(SIZES))))
+    parser.add_option('-d', '--data-dir', metavar='DIR', dest='data_dir',
+                      default=os.path.join(tempfile.gettempdir(), 'bench_data'),
+                      help='where generated inputs are kept (default: %default)')
+    parser.add_option('-j', '--jobs', type='int', metavar='N', dest='jobs',
+                      default=2, help='worker processes for the -j cases')
+    parser.add_option('-r', '--repeat', type='int', metavar='N', dest='repeat',
+                      default=1, help='runs per case, the fastest is kept')
+    parser.add_option('-k', '--only', metavar='NAME', dest='only', action='append',
+                      help='run only cases whose name contains NAME')
+    parser.add_option('-o', '--output', metavar='FILE', dest='output',
+                      help='save results as JSON')
+    parser.add_option('--save-baseline', metavar='FILE', dest='save_baseline',
+                      help='save results as the baseline to compare against')
+    parser.add_option('--baseline', metavar='FILE', dest='baseline',
+                      help='compare results against a saved baseline')
+    parser.add_option('--check', action='store_true', dest='check', default=False,
+                      help='check that -j runs print the same as serial runs '
+                           'instead of benchmarking')
+    parser.add_option('--tolerance', type='float', metavar='FRACTION',
+                      dest='tolerance', default=0.1,
+                      help='relative change counted as a regression '
+                           '(default: %default)')
+
+    (options, args) = parser.parse_args()
+
+    info = prepare_data(options.data_dir, options.size)
+    if options.check:
+        failed = check(os.path.join(options.data_dir, options.size), options.jobs)
+        if failed:
+            print "{0} checks failed".format(len(failed))
+            exit(1)
+        print "All checks passed"
+        exit(0)
+
+    results = benchmark(os.path.join(options.data_dir, options.size), info,
+                        options.jobs, options.repeat, options.only)
+    report = {'size': options.size, 'python': sys.version.split()[0], 'results': results}
+
+    for path in (options.output, options.save_baseline):
+        if path:
+            with open(path, 'w') as out:
+                json.dump(report, out, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['size'] != options.size:
+            print "Baseline was run with size {0}".format(baseline['size'])
+            exit(-1)
+
+        print
+        regressions = compare(results, baseline['results'], options.tolerance)
+        if regressions:
+            print "{0} regressions".format(len(regressions))
+            exit(1)
+        print "No regressions"
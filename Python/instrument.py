@@ -0,0 +1,234 @@
+"""Stage timers, counters and memory snapshots shared by the scripts.
+
+A script wraps its phases in named stages:
+
+    with instrument.stage('learn', "Learning...", "Learned"):
+        ...
+
+or decorates a function with instrument.stage(...). Each stage keeps its
+total time, call count and the process RSS when it ended, and still
+prints the '<message> in N ms' lines the scripts always printed.
+instrument.count() adds to named counters, instrument.snapshot() records
+memory at any point.
+
+add_options() gives an OptionParser --stats FILE, which writes all of it
+as JSON, --profile DIR, which runs cProfile over every stage and saves
+DIR/<stage>.prof (a stage's profile includes the stages nested in it),
+and --trace-memory, which records the top allocations
+of every stage with tracemalloc where it exists (Python 3.4+).
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import functools
+import resource
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+TOP_ENTRIES = 15
+
+
+def current_rss_mb():
+    """Resident set size now, or None where /proc is missing."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        peak /= 1024
+    # the kernel updates the peak lazily, it may lag behind the current RSS
+    return max(peak / 1024.0, current_rss_mb() or 0)
+
+
+class Instrumentation(object):
+    def __init__(self):
+        self.stage_names = list()
+        self.stages = dict()
+        self.counters = dict()
+        self.snapshots = list()
+        self.profiles = dict()
+        self.allocations = dict()
+
+        self.stats_path = None
+        self.profile_dir = None
+        self.trace_memory = False
+        # profilers of the running stages, and per running stage the
+        # profilers of what it covers: its own and its nested stages'
+        self.__running = list()
+        self.__covered = list()
+        self.__stage_stats = dict()
+
+    def configure(self, stats_path=None, profile_dir=None, trace_memory=False):
+        self.stats_path = stats_path
+        self.profile_dir = profile_dir
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        if trace_memory and tracemalloc is None:
+            sys.stderr.write("tracemalloc is not available, --trace-memory ignored\n")
+            trace_memory = False
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stage(self, name, message_before='', message_after=''):
+        """Context manager and decorator timing a named stage."""
+        return _Stage(self, name, message_before, message_after)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self, label):
+        entry = {'label': label, 'rss_mb': current_rss_mb(), 'peak_rss_mb': peak_rss_mb()}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            entry['traced_mb'] = current / 1024.0 / 1024
+            entry['traced_peak_mb'] = peak / 1024.0 / 1024
+        self.snapshots.append(entry)
+        return entry
+
+    def _start(self, name):
+        """Start optional captures of a stage, return their state."""
+        profiler = None
+        if self.profile_dir is not None:
+            # only one profiler can run: the parent's pauses meanwhile
+            if self.__running:
+                self.__running[-1].disable()
+            profiler = cProfile.Profile()
+            self.__running.append(profiler)
+            self.__covered.append([profiler])
+            profiler.enable()
+
+        memory = tracemalloc.take_snapshot() if self.trace_memory else None
+        return profiler, memory
+
+    def _finish(self, name, elapsed_time, captures):
+        profiler, memory = captures
+        if profiler is not None:
+            profiler.disable()
+            self.__running.pop()
+            covered = self.__covered.pop()
+            if self.__covered:
+                self.__covered[-1].extend(covered)
+            if self.__running:
+                self.__running[-1].enable()
+            self.__save_profile(name, covered)
+        if memory is not None:
+            self.__save_allocations(name, memory)
+
+        stage = self.stages.get(name)
+        if stage is None:
+            self.stage_names.append(name)
+            stage = self.stages[name] = {'seconds': 0.0, 'calls': 0}
+        stage['seconds'] += elapsed_time
+        stage['calls'] += 1
+        stage['rss_mb'] = current_rss_mb()
+        stage['peak_rss_mb'] = peak_rss_mb()
+
+    def __save_profile(self, name, profilers):
+        stats = self.__stage_stats.get(name)
+        if stats is None:
+            stats = self.__stage_stats[name] = pstats.Stats(*profilers)
+        else:
+            stats.add(*profilers)
+        stats.dump_stats(os.path.join(self.profile_dir, '{0}.prof'.format(name)))
+
+        stats = stats.stats
+        by_cumulative = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+        self.profiles[name] = [
+            {'function': '{0}:{1}({2})'.format(*function), 'calls': calls,
+             'own_seconds': own_time, 'cumulative_seconds': cumulative_time}
+            for function, (primitive_calls, calls, own_time, cumulative_time, callers)
+            in by_cumulative[:TOP_ENTRIES]]
+
+    def __save_allocations(self, name, before):
+        differences = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+        self.allocations[name] = [
+            {'location': str(difference.traceback), 'size_kb': difference.size_diff / 1024.0,
+             'count': difference.count_diff}
+            for difference in differences[:TOP_ENTRIES]]
+
+    def report(self):
+        return {
+            'argv': sys.argv,
+            'stages': [dict(self.stages[name], name=name) for name in self.stage_names],
+            'counters': self.counters,
+            'snapshots': self.snapshots,
+            'profiles': self.profiles,
+            'allocations': self.allocations,
+            'peak_rss_mb': peak_rss_mb(),
+        }
+
+    def finish(self):
+        """Write the --stats file, if one was asked for."""
+        if self.stats_path is None:
+            return
+
+        with open(self.stats_path, 'w') as stats_file:
+            json.dump(self.report(), stats_file, indent=2, sort_keys=True)
+
+
+class _Stage(object):
+    def __init__(self, instrumentation, name, message_before, message_after):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.message_before = message_before
+        self.message_after = message_after
+
+    def __enter__(self):
+        if self.message_before != '':
+            print(self.message_before)
+        self.captures = self.instrumentation._start(self.name)
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_time = time.time() - self.start_time
+        self.instrumentation._finish(self.name, elapsed_time, self.captures)
+        if exc_type is None and self.message_after != '':
+            print(self.message_after + ' in {} ms\n'.format(int(elapsed_time * 1000)))
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def newfunc(*args, **kwargs):
+            with _Stage(self.instrumentation, self.name,
+                        self.message_before, self.message_after):
+                return func(*args, **kwargs)
+
+        return newfunc
+
+
+INSTRUMENTATION = Instrumentation()
+stage = INSTRUMENTATION.stage
+count = INSTRUMENTATION.count
+snapshot = INSTRUMENTATION.snapshot
+finish = INSTRUMENTATION.finish
+
+
+def add_options(parser):
+    parser.add_option('--stats', metavar='FILE', dest='stats_path',
+                      help='write stage timings, counters and memory as JSON')
+    parser.add_option('--profile', metavar='DIR', dest='profile_dir',
+                      help='run cProfile over every stage, save DIR/<stage>.prof')
+    parser.add_option('--trace-memory', action='store_true', dest='trace_memory',
+                      default=False,
+                      help='record the top allocations of every stage '
+                           '(needs tracemalloc)')
+
+
+def configure(options):
+    INSTRUMENTATION.configure(options.stats_path, options.profile_dir, options.trace_memory)